@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Collection and setup overhead of lazy_fixture on synthetic test modules.
+
+Every scenario generates two test modules of the same shape: one whose
+parametrize values are lazy fixtures and a plain one whose values are
+constants. Both are run in a fresh interpreter and the reported metric is
+the ratio between their per-item collection and setup times, which keeps
+the numbers comparable across machines. The peak memory allocated during
+collection is traced in a separate run, so tracing does not slow down the
+timed ones. The `unused` scenario runs the same plain module with and
+without the plugin.
+
+    python benchmarks/bench_lazyfixture.py             # run and print
+    python benchmarks/bench_lazyfixture.py --save      # update baseline.json
+    python benchmarks/bench_lazyfixture.py --compare   # fail on regressions
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+HEADER = '''
+import pytest
+from pytest_lazyfixture import lazy_fixture
+
+
+@pytest.fixture(params=[1, 2])
+def one(request):
+    return request.param
+'''
+
+RUNNER = '''
+import json
+import os
+import sys
+import timeit
+
+import pytest
+
+
+class Timer(object):
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.collection = 0.0
+        self.setup = 0.0
+        self.memory = 0
+        self.items = 0
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_collection(self, session):
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        start = timeit.default_timer()
+        yield
+        self.collection += timeit.default_timer() - start
+        if self.trace_memory:
+            self.memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_setup(self, item):
+        start = timeit.default_timer()
+        yield
+        self.setup += timeit.default_timer() - start
+        self.items += 1
+
+
+timer = Timer(os.environ.get('BENCH_TRACE_MEMORY') == '1')
+args = ['-p', 'no:cacheprovider', '-p', 'no:terminal'] + sys.argv[1:]
+exitcode = pytest.main(args, plugins=[timer])
+json.dump({
+    'exitcode': int(exitcode),
+    'collection': timer.collection,
+    'setup': timer.setup,
+    'memory': timer.memory,
+    'items': timer.items,
+}, sys.stdout)
+'''
+
+
+def callspecs(count, lazy):
+    value = "lazy_fixture('one')" if lazy else '1'
+    return HEADER + textwrap.dedent('''
+        @pytest.mark.parametrize('arg', [{value}] * {count})
+        def test_func(arg):
+            pass
+    ''').format(value=value, count=count)
+
+
+def lazy_per_callspec(count, lazy):
+    value = "lazy_fixture('one')" if lazy else '1'
+    argnames = ['arg{}'.format(i) for i in range(count)]
+    return HEADER + textwrap.dedent('''
+        @pytest.mark.parametrize({argnames!r}, [[{value}] * {count}] * 10)
+        def test_func({args}):
+            pass
+    ''').format(argnames=','.join(argnames), value=value, count=count, args=', '.join(argnames))
+
+
+def mixed(count, lazy):
+    # a few lazy values among many plain ones
+    value = "lazy_fixture('one') if i % 1000 == 500 else i" if lazy else 'i'
+    return HEADER + textwrap.dedent('''
+        @pytest.mark.parametrize('arg', [{value} for i in range({count})])
+        def test_func(arg):
+            pass
+    ''').format(value=value, count=count)
+
+
+def unused(count, lazy):
+    return textwrap.dedent('''
+        import pytest
+
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+
+
+        @pytest.mark.parametrize('arg', range({count}))
+        def test_func(arg, one):
+            pass
+    ''').format(count=count)
+
+
+def nested(depth, lazy):
+    # the plain module requests the same chain of fixtures as arguments
+    lines = [HEADER]
+    previous = 'one'
+    for i in range(depth):
+        if lazy:
+            fixture = '''
+                @pytest.fixture(params=[lazy_fixture('{previous}'), 2])
+                def level{i}(request):
+                    return request.param
+            '''
+        else:
+            fixture = '''
+                @pytest.fixture(params=[1, 2])
+                def level{i}(request, {previous}):
+                    return request.param
+            '''
+        lines.append(textwrap.dedent(fixture).format(previous=previous, i=i))
+        previous = 'level{}'.format(i)
+
+    if lazy:
+        test = '''
+            @pytest.mark.parametrize('arg', [lazy_fixture('{previous}')] * 10)
+            def test_func(arg):
+                pass
+        '''
+    else:
+        test = '''
+            @pytest.mark.parametrize('arg', [1] * 10)
+            def test_func(arg, {previous}):
+                pass
+        '''
+    lines.append(textwrap.dedent(test).format(previous=previous))
+    return '\n'.join(lines)
+
+
+SCENARIOS = [
+    ('callspecs-100', lambda lazy: callspecs(100, lazy)),
+    ('callspecs-1000', lambda lazy: callspecs(1000, lazy)),
+    ('lazy-per-callspec-10', lambda lazy: lazy_per_callspec(10, lazy)),
+    ('lazy-per-callspec-50', lambda lazy: lazy_per_callspec(50, lazy)),
+    ('nested-3', lambda lazy: nested(3, lazy)),
+    ('nested-8', lambda lazy: nested(8, lazy)),
+    ('wide-grid-300', lambda lazy: lazy_per_callspec(300, lazy)),
+    ('mixed-5000', lambda lazy: mixed(5000, lazy)),
+    ('unused-1000', lambda lazy: unused(1000, lazy), ['-p', 'no:lazy-fixture']),
+]
+
+
+def run_module(source, repeat, args=()):
+    tmpdir = tempfile.mkdtemp(prefix='bench-lazyfixture-')
+    try:
+        with open(os.path.join(tmpdir, 'test_bench.py'), 'w') as f:
+            f.write(source)
+        runs = [run_once(tmpdir, args) for _ in range(repeat)]
+        memory = run_once(tmpdir, args, trace_memory=True)['memory']
+        items = max(runs[0]['items'], 1)
+        return {
+            'collection': min(run['collection'] for run in runs) / items,
+            'setup': min(run['setup'] for run in runs) / items,
+            'memory': float(memory) / items,
+            'items': runs[0]['items'],
+        }
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run_once(tmpdir, args, trace_memory=False):
+    env = dict(os.environ, BENCH_TRACE_MEMORY='1' if trace_memory else '0')
+    output = subprocess.check_output(
+        [sys.executable, '-c', RUNNER, 'test_bench.py'] + list(args), cwd=tmpdir, env=env
+    )
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    if result['exitcode'] != 0:
+        raise RuntimeError('benchmark module failed with exit code {}'.format(result['exitcode']))
+    return result
+
+
+def run_scenario(make_module, repeat, plain_args=()):
+    lazy = run_module(make_module(True), repeat)
+    plain = run_module(make_module(False), repeat, plain_args)
+    return {
+        'items': lazy['items'],
+        'collection_per_item': lazy['collection'],
+        'setup_per_item': lazy['setup'],
+        'memory_per_item': lazy['memory'],
+        'collection_ratio': lazy['collection'] / plain['collection'],
+        'setup_ratio': lazy['setup'] / plain['setup'],
+        'memory_ratio': lazy['memory'] / plain['memory'],
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for metric in ('collection_ratio', 'setup_ratio', 'memory_ratio'):
+            if metric not in expected:
+                continue
+            limit = expected[metric] * (1 + tolerance)
+            if result[metric] > limit:
+                regressions.append('{}: {} {:.2f} > {:.2f}'.format(name, metric, result[metric], limit))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='keyword', default='', help='only run scenarios containing KEYWORD.')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per module, the fastest is kept.')
+    parser.add_argument('--save', action='store_true', help='write the results to baseline.json.')
+    parser.add_argument('--compare', action='store_true', help='fail if a ratio regressed against baseline.json.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative increase of a ratio with --compare (default: %(default)s).')
+    options = parser.parse_args(argv)
+
+    results = {}
+    row = '{:<24} {:>7} {:>20} {:>8} {:>16} {:>8} {:>16} {:>8}'
+    print(row.format(
+        'scenario', 'items', 'collection/item (ms)', 'ratio', 'setup/item (ms)', 'ratio', 'memory/item (KB)', 'ratio'
+    ))
+    for scenario in SCENARIOS:
+        name, make_module = scenario[:2]
+        if options.keyword not in name:
+            continue
+        result = results[name] = run_scenario(make_module, options.repeat, *scenario[2:])
+        print(row.format(
+            name, result['items'],
+            '{:.3f}'.format(result['collection_per_item'] * 1000), '{:.2f}'.format(result['collection_ratio']),
+            '{:.3f}'.format(result['setup_per_item'] * 1000), '{:.2f}'.format(result['setup_ratio']),
+            '{:.2f}'.format(result['memory_per_item'] / 1024), '{:.2f}'.format(result['memory_ratio'])
+        ))
+
+    if options.save:
+        baseline = {}
+        if os.path.exists(BASELINE):
+            with open(BASELINE) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if options.compare:
+        with open(BASELINE) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
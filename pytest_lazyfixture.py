@@ -1,25 +1,158 @@
 # -*- coding: utf-8 -*-
 import copy
+import functools
+import hashlib
+import inspect
+import itertools
+import json
 import sys
+import threading
+import timeit
 import types
-from collections import defaultdict
+import weakref
+from collections import defaultdict, OrderedDict
+try:
+    from collections import ChainMap
+except ImportError:
+    ChainMap = None
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+try:
+    import dataclasses
+except ImportError:
+    dataclasses = None
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 import pytest
+from _pytest.compat import getfuncargnames
+from _pytest.config import UsageError
+from _pytest.fixtures import FixtureRequest
+try:
+    from _pytest.fixtures import resolve_fixture_function
+except ImportError:
+    resolve_fixture_function = None
 
 
 PY3 = sys.version_info[0] == 3
 string_type = str if PY3 else basestring
 
+DEFAULT_LAZY_FIXTURE_THREADS = 4
 
-def pytest_configure():
+# hex digits of the sha1 hash that ends compacted ids
+LAZY_FIXTURE_ID_HASH_LENGTH = 10
+
+LAZY_FIXTURE_SCOPES = ('session', 'package', 'module', 'class', 'function')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('lazy-fixture')
+    group.addoption(
+        '--lazy-fixture-reorder', action='store_true', default=False,
+        help='run items that lazily use the same higher-scoped fixtures next to each other.'
+    )
+    group.addoption(
+        '--lazy-fixture-xdist-group', action='store_true', default=False,
+        help='mark items with xdist_group by the higher-scoped fixtures their lazy values use, '
+             'so --dist=loadgroup sends them to the same worker.'
+    )
+    group.addoption(
+        '--lazy-fixture-profile', action='store_true', default=False,
+        help='measure how long lazy fixtures take to resolve and report the slowest ones.'
+    )
+    group.addoption(
+        '--lazy-fixture-profile-top', type=int, default=10, metavar='N',
+        help='number of lazy fixtures shown in the profile report (default: %(default)s).'
+    )
+    group.addoption(
+        '--lazy-fixture-profile-json', default=None, metavar='PATH',
+        help='write the lazy fixture profile to PATH as JSON; implies --lazy-fixture-profile.'
+    )
+    group.addoption(
+        '--lazy-fixture-graph', default=None, metavar='PATH',
+        help='write the graph of items, their lazy values and fixture closures to PATH, '
+             'as DOT if it ends with .dot or .gv and as JSON otherwise.'
+    )
+    parser.addini(
+        'lazy_fixture_containers', type='bool', default=False,
+        help='resolve lazy fixtures nested in tuples, lists, dicts and dataclasses of parametrize values.'
+    )
+    parser.addini(
+        'lazy_fixture_threads', default='0',
+        help='size of the thread pool that sets up independent lazy fixtures of an item concurrently, 0 disables it.'
+    )
+    parser.addini(
+        'lazy_fixture_id_max_length', default='0',
+        help='shorten ids of tests with lazy values that are longer than this to a prefix and a hash, '
+             '0 disables it, otherwise it must be at least {}.'.format(LAZY_FIXTURE_ID_HASH_LENGTH)
+    )
+    parser.addini(
+        'lazy_fixture_max_depth', default='100',
+        help='max nesting of lazy values whose fixtures are parametrized with lazy values, 0 disables the limit.'
+    )
+    parser.addini(
+        'lazy_fixture_gather_async', type='bool', default=False,
+        help='set up independent function-scoped async lazy fixtures of an item concurrently on one event loop.'
+    )
+
+
+def pytest_configure(config):
     pytest.lazy_fixture = lazy_fixture
+    lazy_fixture_id_max_length(config)
+    config.pluginmanager.register(FixtureClosureCache(), 'lazy-fixture-closure-cache')
 
+    json_path = config.getoption('lazy_fixture_profile_json')
+    if config.getoption('lazy_fixture_profile') or json_path:
+        profiler = LazyFixtureProfiler(config.getoption('lazy_fixture_profile_top'), json_path)
+        config.pluginmanager.register(profiler, 'lazy-fixture-profiler')
 
-@pytest.hookimpl(tryfirst=True)
-def pytest_runtest_setup(item):
-    if hasattr(item, '_request'):
-        item._request._fillfixtures = types.MethodType(
-            fillfixtures(item._request._fillfixtures), item._request
-        )
+    graph_path = config.getoption('lazy_fixture_graph')
+    if graph_path:
+        config.pluginmanager.register(LazyFixtureGraph(graph_path), 'lazy-fixture-graph')
+
+    if config.getoption('lazy_fixture_xdist_group'):
+        config.addinivalue_line('markers', 'xdist_group(name): run items of the same group on the same xdist worker.')
+        config.pluginmanager.register(XdistGroupMarker(), 'lazy-fixture-xdist-group')
+
+    config.addinivalue_line(
+        'markers',
+        'lazy_fixture_threads(n={}): set up independent lazy fixtures of the test '
+        'concurrently in a pool of n threads.'.format(DEFAULT_LAZY_FIXTURE_THREADS)
+    )
+
+    install_fillfixtures()
+
+
+def pytest_unconfigure(config):
+    uninstall_fillfixtures()
+
+
+_fillfixtures_installs = []
+
+
+def install_fillfixtures():
+    """Wrap `FixtureRequest._fillfixtures` once for all items.
+
+    Nested sessions (e.g. pytester's inline runs) share the wrapper, it is
+    removed when the outermost session is unconfigured.
+    """
+    if not _fillfixtures_installs:
+        FixtureRequest._fillfixtures = fillfixtures(FixtureRequest._fillfixtures)
+    _fillfixtures_installs.append(FixtureRequest._fillfixtures)
+
+
+def uninstall_fillfixtures():
+    if _fillfixtures_installs:
+        fill = _fillfixtures_installs.pop()
+        if not _fillfixtures_installs:
+            FixtureRequest._fillfixtures = fill._original
 
 
 def fillfixtures(_fillfixtures):
@@ -30,128 +163,1257 @@ def fillfixtures(_fillfixtures):
             fixturenames = request.fixturenames
 
         if hasattr(item, 'callspec'):
-            for param, val in sorted_by_dependency(item.callspec.params, fixturenames):
-                if val is not None and is_lazy_fixture(val):
-                    item.callspec.params[param] = request.getfixturevalue(val.name)
+            try:
+                plan = item._lazyfixture_plan
+            except AttributeError:
+                plan = resolution_plan(item.callspec.params, fixturenames)
+
+        if hasattr(item, 'callspec') and plan is not None:
+            prefetched = False
+            for param, lazy in plan:
+                val = item.callspec.params.get(param)
+                if lazy and is_lazy_fixture(val):
+                    if not prefetched:
+                        prefetch_lazy_fixtures(request, plan)
+                        prefetched = True
+                    item.callspec.params[param] = resolve_lazy_fixture(request, val)
                 elif param not in item.funcargs:
                     item.funcargs[param] = request.getfixturevalue(param)
 
-        _fillfixtures()
+        _fillfixtures(request)
+
+    fill._original = _fillfixtures
     return fill
 
 
 @pytest.hookimpl(tryfirst=True)
 def pytest_fixture_setup(fixturedef, request):
+    prefetched = pop_prefetched_fixture(fixturedef, request)
+    if prefetched is not None:
+        return prefetched.setup(fixturedef, request)
+
     val = getattr(request, 'param', None)
     if is_lazy_fixture(val):
-        request.param = request.getfixturevalue(val.name)
+        request.param = resolve_lazy_fixture(request, val)
 
 
 def pytest_runtest_call(item):
-    if hasattr(item, 'funcargs'):
-        for arg, val in item.funcargs.items():
-            if is_lazy_fixture(val):
-                item.funcargs[arg] = item._request.getfixturevalue(val.name)
+    lazy_funcargs = getattr(item, '_lazyfixture_funcargs', None)
+    if lazy_funcargs is None:
+        # the item was not collected by `pytest_pycollect_makeitem`
+        funcargs = getattr(item, 'funcargs', {})
+        lazy_funcargs = [arg for arg, val in funcargs.items() if is_lazy_fixture(val)]
+
+    for arg in lazy_funcargs:
+        val = item.funcargs.get(arg)
+        if is_lazy_fixture(val):
+            item.funcargs[arg] = resolve_lazy_fixture(item._request, val)
+
+
+def resolve_lazy_fixture(request, val):
+    if isinstance(val, LazyContainer):
+        return val.resolve(functools.partial(resolve_lazy_fixture, request))
+    if val.scope is None:
+        return _resolve_lazy_fixture(request, val)
+
+    item = request._pyfuncitem
+    node = _scope_node(item, val.scope)
+    results = getattr(node, '_lazyfixture_results', None)
+    if results is None:
+        results = node._lazyfixture_results = {}
+        node.addfinalizer(functools.partial(delattr, node, '_lazyfixture_results'))
+
+    key = (val, _lazy_param_key(item, val))
+    try:
+        return results[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable index in the path of `val`
+        return _resolve_lazy_fixture(request, val)
+    value = results[key] = _resolve_lazy_fixture(request, val)
+    return value
+
+
+def _resolve_lazy_fixture(request, val):
+    values = getfixturevalues(request, val._argnames)
+    if val._func is None:
+        value = values[0]
+    else:
+        value = val._func(**dict(zip(val._argnames, values)))
+
+    for kind, key in val._path:
+        value = getattr(value, key) if kind == 'attr' else value[key]
+    return value
+
+
+def getfixturevalues(request, names):
+    """Return values of fixtures `names` in order.
+
+    Values are kept on the item until it is torn down, so lazy values that
+    share fixtures look each of them up only once per item.
+    """
+    item = request._pyfuncitem
+    values = item.__dict__.get('_lazyfixture_values')
+    if values is None:
+        values = item._lazyfixture_values = {}
+        item.addfinalizer(functools.partial(item.__dict__.pop, '_lazyfixture_values', None))
+
+    missing = [name for name in OrderedDict.fromkeys(names) if name not in values]
+    if missing:
+        profiler = request.config.pluginmanager.get_plugin('lazy-fixture-profiler')
+        getfixturevalue = request.getfixturevalue
+        if profiler is not None:
+            getfixturevalue = functools.partial(profiler.getfixturevalue, request)
+        for name in missing:
+            values[name] = getfixturevalue(name)
+    return [values[name] for name in names]
+
+
+def _scope_node(item, scope):
+    if scope == 'function':
+        return item
+    if scope == 'class':
+        node = item.getparent(pytest.Class)
+        if node is not None:
+            return node
+        scope = 'module'
+    if scope == 'module':
+        return item.getparent(pytest.Module)
+    if scope == 'package' and hasattr(pytest, 'Package'):
+        node = item.getparent(pytest.Package)
+        if node is not None:
+            return node
+    return item.session
+
+
+def _lazy_param_key(item, val):
+    """Return the fixtures that `val` depends on and their param indices.
+
+    Fixtures are identified by their definitions, because a name may be
+    overridden in a conftest or module under the same scope node.
+    """
+    fm = item.session._fixturemanager
+    closure_cache = item.config.pluginmanager.get_plugin('lazy-fixture-closure-cache')
+    fixturenames_closure, arg2fixturedefs = closure_cache.getfixtureclosure(fm, val._argnames, item.parent)
+    indices = getattr(getattr(item, 'callspec', None), 'indices', {})
+    return tuple(
+        (name, tuple(id(fixturedef) for fixturedef in arg2fixturedefs.get(name, ())), indices.get(name))
+        for name in fixturenames_closure
+    )
+
+
+def check_lazy_fixture_scope(val, fixturenames_closure, arg2fixturedefs):
+    """Fail if fixtures used by a scoped lazy value are narrower than its scope."""
+    if val.scope is None:
+        return
+
+    scopenum = LAZY_FIXTURE_SCOPES.index(val.scope)
+    narrower = ['request (function)'] if 'request' in val._argnames else []
+    for name in fixturenames_closure:
+        if name not in arg2fixturedefs:
+            continue
+        scope = arg2fixturedefs[name][-1].scope
+        if scope in LAZY_FIXTURE_SCOPES and LAZY_FIXTURE_SCOPES.index(scope) > scopenum:
+            narrower.append('{} ({})'.format(name, scope))
+
+    if narrower:
+        pytest.fail(
+            '{!r} has scope {!r} but uses narrower-scoped fixtures: {}'.format(val, val.scope, ', '.join(narrower)),
+            pytrace=False
+        )
+
+
+def prefetch_lazy_fixtures(request, plan):
+    """Set up independent lazy fixtures of an item concurrently.
+
+    Only the fixture functions run concurrently. Their results are handed to
+    pytest by `pytest_fixture_setup` when `fillfixtures` resolves the lazy
+    values in plan order, so caching and teardown order stay the same.
+    """
+    gather_async = asyncio is not None and request.config.getini('lazy_fixture_gather_async')
+    threads = lazy_fixture_threads(request._pyfuncitem)
+    if not gather_async and not threads:
+        return
+
+    fixturedefs = independent_lazy_fixturedefs(request, plan)
+    # anyio runs async fixtures of items that use `anyio_backend` on its own backend
+    if gather_async and 'anyio_backend' not in request._pyfuncitem.fixturenames:
+        async_fixturedefs = [
+            fixturedef for fixturedef in fixturedefs if _async_fixture_function(fixturedef) is not None
+        ]
+        if async_fixturedefs:
+            # a single one is awaited too, pytest would pass on its coroutine
+            gather_async_fixtures(request, async_fixturedefs)
+    if threads:
+        sync_fixturedefs = [fixturedef for fixturedef in fixturedefs if _async_fixture_function(fixturedef) is None]
+        if len(sync_fixturedefs) > 1:
+            setup_fixtures_in_threads(request, sync_fixturedefs, threads)
+
+
+def lazy_fixture_threads(item):
+    """Return the size of the thread pool for setting up lazy fixtures of `item`.
+
+    It is taken from the `lazy_fixture_threads` marker or ini option, 0 means
+    that the fixtures are set up sequentially.
+    """
+    if ThreadPoolExecutor is None:
+        return 0
+
+    marker = item.get_closest_marker('lazy_fixture_threads')
+    if marker is not None:
+        return int(marker.args[0] if marker.args else marker.kwargs.get('n', DEFAULT_LAZY_FIXTURE_THREADS))
+    return int(item.config.getini('lazy_fixture_threads') or 0)
+
+
+def independent_lazy_fixturedefs(request, plan):
+    """Return fixturedefs of lazy values that can be set up independently.
+
+    These are function-scoped, not parametrized, do not use `request`, are
+    not set up yet and do not depend on each other. Fixtures of other scopes
+    are left to pytest, which checks the scopes of their dependencies and
+    caches them per scope.
+    """
+    item = request._pyfuncitem
+    params = item.callspec.params
+    fm = request._fixturemanager
+    parentid = item.parent.nodeid
+
+    candidates = OrderedDict()
+    for param, lazy in plan:
+        val = params.get(param)
+        if not lazy or not isinstance(val, LazyFixture) or val._func is not None:
+            continue
+        if val.name in params or val.name in candidates:
+            continue
+        fixturedefs = fm.getfixturedefs(val.name, parentid)
+        if not fixturedefs:
+            continue
+        fixturedef = fixturedefs[-1]
+        # pytest < 5.0.0 only sets `cached_result` once the fixture was set up
+        if (fixturedef.scope == 'function' and fixturedef.params is None and
+                getattr(fixturedef, 'cached_result', None) is None and
+                'request' not in _fixture_argnames(fixturedef)):
+            candidates[val.name] = fixturedef
+
+    dependencies = dict(
+        (name, _fixture_dependencies(fm, fixturedef, parentid)) for name, fixturedef in candidates.items()
+    )
+    return [
+        fixturedef for name, fixturedef in candidates.items()
+        if not any(name in deps or other in dependencies[name] for other, deps in dependencies.items() if other != name)
+    ]
+
+
+def _fixture_dependencies(fm, fixturedef, parentid):
+    dependencies = set()
+    stack = list(fixturedef.argnames)
+    while stack:
+        name = stack.pop()
+        if name in dependencies:
+            continue
+        dependencies.add(name)
+        fixturedefs = fm.getfixturedefs(name, parentid)
+        if fixturedefs:
+            stack.extend(fixturedefs[-1].argnames)
+    return dependencies
+
+
+def _fixture_function(fixturedef, request):
+    if resolve_fixture_function is not None:
+        return resolve_fixture_function(fixturedef, request)
+    if request.instance is None:
+        return fixturedef.func
+    # pytest < 4.0; fixture methods of test classes are set up sequentially
+    return None
+
+
+def _async_fixture_function(fixturedef):
+    """Return the async function of `fixturedef`, or None if it is not async.
+
+    pytest-asyncio replaces async fixture functions with sync wrappers that
+    run them on its `event_loop`, the wrapped function is returned for those.
+    """
+    func = fixturedef.func
+    wrapped = getattr(func, '__wrapped__', None)
+    if wrapped is not None and getattr(wrapped, '_force_asyncio_fixture', False) and _is_async_function(wrapped):
+        return wrapped
+    return func if _is_async_function(func) else None
+
+
+def _is_async_function(func):
+    isasyncgenfunction = getattr(inspect, 'isasyncgenfunction', None)
+    return (
+        getattr(inspect, 'iscoroutinefunction', None) is not None and inspect.iscoroutinefunction(func)
+        or isasyncgenfunction is not None and isasyncgenfunction(func)
+    )
+
+
+def _fixture_argnames(fixturedef):
+    func = _async_fixture_function(fixturedef)
+    if func is None or func is fixturedef.func:
+        return fixturedef.argnames
+    # pytest-asyncio adds `request` and `event_loop` to argnames of its wrappers
+    return tuple(getfuncargnames(func))
+
+
+def gather_async_fixtures(request, fixturedefs):
+    item = request._pyfuncitem
+    loop = _event_loop(request, fixturedefs)
+    if loop.is_running():
+        return
+
+    awaitables = []
+    generators = []
+    for fixturedef in fixturedefs:
+        func = _async_fixture_function(fixturedef)
+        if func is not fixturedef.func:
+            if request.instance is not None:
+                # pytest-asyncio binds fixture methods of test classes itself
+                continue
+        else:
+            func = _fixture_function(fixturedef, request)
+            if func is None:
+                continue
+        kwargs = dict((argname, request.getfixturevalue(argname)) for argname in _fixture_argnames(fixturedef))
+        if inspect.isasyncgenfunction(func):
+            generator = func(**kwargs)
+            awaitables.append(generator.__anext__())
+        else:
+            generator = None
+            awaitables.append(func(**kwargs))
+        generators.append((fixturedef, generator))
+
+    futures = [asyncio.ensure_future(awaitable, loop=loop) for awaitable in awaitables]
+    results = loop.run_until_complete(asyncio.gather(*futures, return_exceptions=True))
+
+    prefetched = _prefetched_fixtures(item)
+    for (fixturedef, generator), result in zip(generators, results):
+        if isinstance(result, BaseException):
+            prefetched[fixturedef.argname] = PrefetchedFixture(fixturedef, exception=result)
+        else:
+            finalizer = None
+            if generator is not None:
+                finalizer = functools.partial(_finish_async_generator, loop, generator)
+            prefetched[fixturedef.argname] = PrefetchedFixture(fixturedef, result, finalizer=finalizer)
+
+
+def setup_fixtures_in_threads(request, fixturedefs, threads):
+    calls = []
+    for fixturedef in fixturedefs:
+        kwargs = dict((argname, request.getfixturevalue(argname)) for argname in fixturedef.argnames)
+        func = _fixture_function(fixturedef, request)
+        if func is not None:
+            calls.append((fixturedef, func, kwargs))
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(calls))) as executor:
+        futures = [executor.submit(_call_fixture_function, func, kwargs) for _, func, kwargs in calls]
+
+    prefetched = _prefetched_fixtures(request._pyfuncitem)
+    for (fixturedef, _, _), future in zip(calls, futures):
+        exception = future.exception()
+        if exception is not None:
+            prefetched[fixturedef.argname] = PrefetchedFixture(fixturedef, exception=exception)
+        else:
+            result, generator = future.result()
+            finalizer = None
+            if generator is not None:
+                finalizer = functools.partial(_finish_generator, generator)
+            prefetched[fixturedef.argname] = PrefetchedFixture(fixturedef, result, finalizer=finalizer)
+
+
+def _call_fixture_function(func, kwargs):
+    if not inspect.isgeneratorfunction(func):
+        return func(**kwargs), None
+
+    generator = func(**kwargs)
+    try:
+        return next(generator), generator
+    except StopIteration:
+        raise ValueError('{} did not yield a value'.format(func.__name__))
+
+
+def _finish_generator(generator):
+    try:
+        next(generator)
+    except StopIteration:
+        return
+    pytest.fail("fixture function has more than one 'yield'", pytrace=False)
+
+
+def _event_loop(request, fixturedefs):
+    item = request._pyfuncitem
+    if 'event_loop' in item.fixturenames or any('event_loop' in fixturedef.argnames for fixturedef in fixturedefs):
+        # share the loop of pytest-asyncio, its async fixtures depend on it
+        return request.getfixturevalue('event_loop')
+
+    loop = asyncio.new_event_loop()
+    item.addfinalizer(loop.close)
+    return loop
+
+
+def _finish_async_generator(loop, generator):
+    try:
+        loop.run_until_complete(generator.__anext__())
+    except StopAsyncIteration:
+        return
+    pytest.fail("fixture function has more than one 'yield'", pytrace=False)
+
+
+def _prefetched_fixtures(item):
+    prefetched = item.__dict__.get('_lazyfixture_prefetched')
+    if prefetched is None:
+        prefetched = item._lazyfixture_prefetched = {}
+        item.addfinalizer(functools.partial(_discard_prefetched_fixtures, prefetched))
+    return prefetched
+
+
+def _discard_prefetched_fixtures(prefetched):
+    # fixtures that were set up but never handed to pytest, e.g. the setup failed before
+    while prefetched:
+        _, fixture = prefetched.popitem()
+        if fixture.finalizer is not None:
+            fixture.finalizer()
+
+
+def pop_prefetched_fixture(fixturedef, request):
+    item = getattr(request, '_pyfuncitem', None)
+    prefetched = getattr(item, '_lazyfixture_prefetched', None)
+    if not prefetched:
+        return None
+
+    fixture = prefetched.get(fixturedef.argname)
+    if fixture is None or fixture.fixturedef is not fixturedef:
+        return None
+    return prefetched.pop(fixturedef.argname)
+
+
+# `pytest_fixture_setup` is a firstresult hook, a prefetched value of None is
+# returned as this so pytest does not call the fixture function again
+_PREFETCHED_NONE = object()
+
+
+class PrefetchedFixture(object):
+    """Result of a fixture function that was set up ahead of pytest."""
+
+    __slots__ = ('fixturedef', 'result', 'exception', 'finalizer')
+
+    def __init__(self, fixturedef, result=None, exception=None, finalizer=None):
+        self.fixturedef = fixturedef
+        self.result = result
+        self.exception = exception
+        self.finalizer = finalizer
+
+    def setup(self, fixturedef, request):
+        if self.exception is not None:
+            raise self.exception
+        if self.finalizer is not None:
+            request.addfinalizer(self.finalizer)
+
+        try:
+            cache_key = fixturedef.cache_key(request)
+        except AttributeError:
+            # pytest < 5.4.0
+            cache_key = request.param_index
+        fixturedef.cached_result = (self.result, cache_key, None)
+        return _PREFETCHED_NONE if self.result is None else self.result
+
+
+class _ThreadLocalVar(object):
+    """`contextvars.ContextVar` for python < 3.7, the value is local to a thread."""
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self.default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+if contextvars is not None:
+    current_collector = contextvars.ContextVar('lazy_fixture_current_collector', default=None)
+else:
+    current_collector = _ThreadLocalVar('lazy_fixture_current_collector')
 
 
 @pytest.hookimpl(hookwrapper=True)
 def pytest_pycollect_makeitem(collector, name, obj):
-    global current_node
-    current_node = collector
-    yield
-    current_node = None
+    token = current_collector.set(collector)
+    try:
+        outcome = yield
+    finally:
+        current_collector.reset(token)
+
+    if outcome.excinfo is None:
+        res = outcome.get_result()
+        items = res if isinstance(res, list) else [res]
+        lazy_definitions = collector.__dict__.get('_lazyfixture_definitions', set())
+        if name in lazy_definitions:
+            lazy_definitions.discard(name)
+            try:
+                attach_resolution_plans(items)
+            except pytest.fail.Exception as exc:
+                _fail_hook(outcome, exc)
+        else:
+            for item in items:
+                if hasattr(item, 'callspec'):
+                    item._lazyfixture_funcargs = ()
+                    item._lazyfixture_plan = None
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(session, config, items):
+    if config.getoption('lazy_fixture_reorder'):
+        items[:] = reorder_items(items)
 
 
 def pytest_make_parametrize_id(config, val, argname):
-    if is_lazy_fixture(val):
-        return val.name
+    if isinstance(val, LazyFixture):
+        try:
+            return val._id
+        except AttributeError:
+            pass
+        if val.name == '<lambda>':
+            # let pytest generate the id
+            id_ = None
+        else:
+            id_ = val.name + ''.join(
+                '.{}'.format(key) if kind == 'attr' else '[{}]'.format(_format_index(key)) for kind, key in val._path
+            )
+        # instances are immutable, `_id` only caches a value derived from them
+        object.__setattr__(val, '_id', id_)
+        return id_
+
+
+def _format_index(key):
+    if not isinstance(key, slice):
+        return key
+    bounds = ['' if bound is None else bound for bound in (key.start, key.stop, key.step)]
+    return '{}:{}:{}'.format(*bounds) if key.step is not None else '{}:{}'.format(*bounds[:2])
+
+
+def _fail_hook(outcome, exc):
+    """Make the hook wrapped by a hookwrapper raise `exc`."""
+    if hasattr(outcome, 'force_exception'):
+        # pluggy >= 1.1; hookwrappers that raise themselves are deprecated
+        outcome.force_exception(exc)
+    else:
+        raise exc
 
 
 @pytest.hookimpl(hookwrapper=True)
 def pytest_generate_tests(metafunc):
-    yield
+    outcome = yield
 
-    normalize_metafunc_calls(metafunc, 'funcargs')
-    normalize_metafunc_calls(metafunc, 'params')
+    try:
+        normalize_metafunc(metafunc)
+    except pytest.fail.Exception as exc:
+        _fail_hook(outcome, exc)
 
 
-def normalize_metafunc_calls(metafunc, valtype, used_keys=None):
-    newcalls = []
-    for callspec in metafunc._calls:
-        calls = normalize_call(callspec, metafunc, valtype, used_keys)
-        newcalls.extend(calls)
-    metafunc._calls = newcalls
+def normalize_metafunc(metafunc):
+    containers = {} if metafunc.config.getini('lazy_fixture_containers') else None
+    if not any([wrap_lazy_containers(callspec, containers) for callspec in metafunc._calls]):
+        return
+
+    # items of other definitions skip lazy fixture resolution
+    definition = getattr(metafunc, 'definition', None)
+    name = metafunc.function.__name__ if definition is None else definition.name
+    _parentnode(metafunc).__dict__.setdefault('_lazyfixture_definitions', set()).add(name)
+
+    unknown = OrderedDict()
+    normalize_metafunc_calls(metafunc, 'funcargs', containers, unknown)
+    normalize_metafunc_calls(metafunc, 'params', containers, unknown)
+    if unknown:
+        pytest.fail('\n'.join(
+            ['{}: lazy_fixture refers to unknown fixtures:'.format(name)] +
+            ['  {!r} used by {}'.format(fixturename, ', '.join(argnames)) for fixturename, argnames in unknown.items()]
+        ), pytrace=False)
+
+    max_length = lazy_fixture_id_max_length(metafunc.config)
+    if max_length:
+        compact_ids(metafunc._calls, max_length)
+
+
+def lazy_fixture_id_max_length(config):
+    """Return the `lazy_fixture_id_max_length` ini option, 0 if ids are not compacted."""
+    value = config.getini('lazy_fixture_id_max_length') or '0'
+    try:
+        max_length = int(value)
+    except ValueError:
+        max_length = -1
+    if max_length != 0 and max_length < LAZY_FIXTURE_ID_HASH_LENGTH:
+        raise UsageError('lazy_fixture_id_max_length must be 0 or at least {}, got {!r}'.format(
+            LAZY_FIXTURE_ID_HASH_LENGTH, value
+        ))
+    return max_length
+
+
+def compact_ids(calls, max_length):
+    """Shorten ids of `calls` longer than `max_length` to a prefix and a sha1 hash of the full id."""
+    for i, callspec in enumerate(calls):
+        callspec_id = callspec.id
+        if len(callspec_id) <= max_length:
+            continue
+
+        # `CallSpec2` is frozen on newer pytest versions
+        calls[i] = copy.copy(callspec)
+        object.__setattr__(calls[i], '_idlist', [_compact_id(callspec_id, max_length)])
+
+
+def _compact_id(callspec_id, max_length):
+    digest = hashlib.sha1(callspec_id.encode('utf-8')).hexdigest()[:LAZY_FIXTURE_ID_HASH_LENGTH]
+    prefix = callspec_id[:max(max_length - len(digest) - 1, 0)]
+    return '{}-{}'.format(prefix, digest) if prefix else digest[:max_length]
+
 
+def wrap_lazy_containers(callspec, containers, keys=None):
+    """Wrap values of `callspec` that contain lazy fixtures in `LazyContainer`.
 
-def copy_metafunc(metafunc):
-    copied = copy.copy(metafunc)
-    copied.fixturenames = copy.copy(metafunc.fixturenames)
-    copied._calls = []
+    `containers` maps ids of values that were already indexed to their
+    wrappers, so a value shared by many callspecs is walked only once.
+    Containers are not walked if it is None, i.e. `lazy_fixture_containers`
+    is disabled. Only values of `keys` are looked at if it is given.
+    Return whether `callspec` has lazy values.
+    """
+    found = False
+    for values in (callspec.params, getattr(callspec, 'funcargs', {})):
+        items = values.items() if keys is None else [(key, values[key]) for key in keys if key in values]
+        for key, val in items:
+            if is_lazy_fixture(val):
+                found = True
+                continue
+            if containers is None or not _is_container(val):
+                continue
+
+            try:
+                _, wrapper = containers[id(val)]
+            except KeyError:
+                tree = lazy_leaves(val)
+                wrapper = LazyContainer(val, tree) if tree is not None else None
+                # keep `val` alive, so its id is not reused by another value
+                containers[id(val)] = val, wrapper
+            if wrapper is not None:
+                values[key] = wrapper
+                found = True
+    return found
+
+
+def _is_container(val):
+    # numpy arrays and other custom sequences are not walked
+    return (
+        type(val) in (tuple, list, dict) or
+        isinstance(val, tuple) and hasattr(val, '_fields') or
+        dataclasses is not None and dataclasses.is_dataclass(val) and not isinstance(val, type)
+    )
 
+
+def lazy_leaves(val, _path=None, _memo=None):
+    """Return the tree of paths from container `val` to its lazy fixtures.
+
+    It is a dict that maps keys, indices or field names to subtrees, a lazy
+    fixture itself is a leaf marked by None. None is also returned if `val`
+    contains no lazy fixtures.
+
+    Subtrees of containers referenced more than once are computed once and
+    shared, containers that contain themselves are not walked again.
+    """
+    path = set() if _path is None else _path
+    memo = {} if _memo is None else _memo
+    if id(val) in memo:
+        return memo[id(val)]
+    if id(val) in path:
+        return None
+    path.add(id(val))
+
+    if isinstance(val, dict):
+        children = val.items()
+    elif isinstance(val, (tuple, list)):
+        children = enumerate(val)
+    else:
+        children = ((field.name, getattr(val, field.name)) for field in dataclasses.fields(val))
+
+    tree = OrderedDict()
+    for key, child in children:
+        if is_lazy_fixture(child):
+            tree[key] = None
+        elif _is_container(child):
+            subtree = lazy_leaves(child, path, memo)
+            if subtree is not None:
+                tree[key] = subtree
+
+    path.discard(id(val))
+    memo[id(val)] = tree = tree or None
+    return tree
+
+
+def _parentnode(metafunc):
     try:
-        copied._ids = copy.copy(metafunc._ids)
+        return metafunc.definition.parent
     except AttributeError:
-        # pytest>=5.3.0
-        pass
+        # pytest < 3.6.0; `Metafunc` has no `definition` attribute
+        return current_collector.get()
+
+
+def normalize_metafunc_calls(metafunc, valtype, containers=None, unknown=None):
+    """Replace callspecs with lazy values by their expansion.
+
+    `metafunc._calls` is left as it is if no callspec has lazy values.
+    Otherwise callspecs are expanded one at a time into a new list that
+    replaces it at the end, so other `pytest_generate_tests` hookwrappers
+    never see a partly expanded list.
+    """
+    calls = metafunc._calls
+    for start, callspec in enumerate(calls):
+        if any(is_lazy_fixture(val) for val in getattr(callspec, valtype).values()):
+            break
+    else:
+        return
+
+    newcalls = calls[:start]
+    for callspec in itertools.islice(calls, start, None):
+        if any(is_lazy_fixture(val) for val in getattr(callspec, valtype).values()):
+            newcalls.extend(normalize_call(callspec, metafunc, valtype, containers, unknown))
+        else:
+            newcalls.append(callspec)
+    metafunc._calls = newcalls
 
-    copied._arg2fixturedefs = copy.copy(metafunc._arg2fixturedefs)
-    return copied
 
+def normalize_call(callspec, metafunc, valtype, containers=None, unknown=None):
+    """Expand every lazy value of `callspec` into the callspecs of its fixture closure.
 
-def normalize_call(callspec, metafunc, valtype, used_keys):
+    Callspecs are expanded depth-first with an explicit worklist, so the order of
+    the resulting calls matches a recursive expansion without its stack depth.
+    Names of lazy values that are neither fixtures nor arguments of the test are
+    added to `unknown` with the arguments that use them.
+
+    Every key added by the expansion of a lazy value remembers that value's key
+    and nesting depth, expansion fails once the depth exceeds `lazy_fixture_max_depth`.
+    """
     fm = metafunc.config.pluginmanager.get_plugin('funcmanage')
+    closure_cache = metafunc.config.pluginmanager.get_plugin('lazy-fixture-closure-cache')
+    max_depth = int(metafunc.config.getini('lazy_fixture_max_depth') or 0)
+
+    parentnode = _parentnode(metafunc)
+
+    calls = []
+    worklist = [(callspec, frozenset(), {})]
+    while worklist:
+        callspec, checked_keys, origins = worklist.pop()
+        values = getattr(callspec, valtype)
+        arg, checked_keys = _next_lazy_key(values, checked_keys)
+        if arg is None:
+            calls.append(callspec)
+            continue
+
+        depth = origins[arg][1] if arg in origins else 1
+        if max_depth and depth > max_depth:
+            pytest.fail(
+                'lazy fixtures are nested deeper than lazy_fixture_max_depth={}: {}'.format(
+                    max_depth, ' -> '.join(reversed(_origin_chain(origins, arg)))
+                ),
+                pytrace=False
+            )
+
+        val = values[arg]
+        fixturenames_closure, arg2fixturedefs = closure_cache.getfixtureclosure(fm, val._argnames, parentnode)
+        check_lazy_fixture_scope(val, fixturenames_closure, arg2fixturedefs)
+        if unknown is not None:
+            for name in val._argnames:
+                if name not in arg2fixturedefs and not _is_known_argname(name, callspec, metafunc):
+                    argnames = unknown.setdefault(name, [])
+                    if arg not in argnames:
+                        argnames.append(arg)
+        extra_fixturenames = [fname for fname in fixturenames_closure
+                              if fname not in callspec.params and fname not in callspec.funcargs]
+
+        newmetafunc = MetafuncView(metafunc, extra_fixturenames, arg2fixturedefs, [callspec])
+        fm.pytest_generate_tests(newmetafunc)
+
+        for newcall in reversed(newmetafunc._calls):
+            newkeys = _new_keys(callspec, newcall)
+            neworigins = origins
+            if newkeys:
+                if containers is not None:
+                    # params of fixtures in the closure may hold lazy fixtures in containers too
+                    wrap_lazy_containers(newcall, containers, newkeys)
+                neworigins = dict(origins)
+                neworigins.update((key, (arg, depth + 1)) for key in newkeys)
+            worklist.append((newcall, checked_keys, neworigins))
+    return calls
 
-    used_keys = used_keys or set()
-    valtype_keys = set(getattr(callspec, valtype).keys()) - used_keys
 
-    for arg in valtype_keys:
-        val = getattr(callspec, valtype)[arg]
+def _new_keys(callspec, newcall):
+    """Return keys that parametrization added to `newcall`, a copy of `callspec`."""
+    newkeys = []
+    for valtype in ('params', 'funcargs'):
+        values = getattr(callspec, valtype, {})
+        newvalues = getattr(newcall, valtype, {})
+        # parametrize only adds keys
+        if len(newvalues) > len(values):
+            newkeys.extend(key for key in newvalues if key not in values)
+    return newkeys
+
+
+def _origin_chain(origins, key):
+    chain = [key]
+    while chain[-1] in origins:
+        chain.append(origins[chain[-1]][0])
+    return chain
+
+
+def _is_known_argname(name, callspec, metafunc):
+    return (
+        name == 'request' or name in callspec.params or name in getattr(callspec, 'funcargs', {}) or
+        name in metafunc._arg2fixturedefs
+    )
+
+
+def _next_lazy_key(values, checked_keys):
+    skipped_keys = []
+    for key, val in values.items():
+        if key in checked_keys:
+            continue
         if is_lazy_fixture(val):
-            try:
-                _, fixturenames_closure, arg2fixturedefs = fm.getfixtureclosure([val.name], metafunc.definition.parent)
-            except ValueError:
-                # 3.6.0 <= pytest < 3.7.0; `FixtureManager.getfixtureclosure` returns 2 values
-                fixturenames_closure, arg2fixturedefs = fm.getfixtureclosure([val.name], metafunc.definition.parent)
-            except AttributeError:
-                # pytest < 3.6.0; `Metafunc` has no `definition` attribute
-                fixturenames_closure, arg2fixturedefs = fm.getfixtureclosure([val.name], current_node)
+            return key, checked_keys.union(skipped_keys, [key])
+        skipped_keys.append(key)
+    return None, checked_keys
+
+
+class MetafuncView(object):
+    """Metafunc that overrides only what the expansion of a lazy value needs.
+
+    `fixturenames`, `_calls` and `_arg2fixturedefs` belong to the view, every other
+    attribute is read from the original metafunc. Methods are bound to the view,
+    so `parametrize` called by `FixtureManager.pytest_generate_tests` writes to it.
+    """
+
+    def __init__(self, metafunc, fixturenames, arg2fixturedefs, calls):
+        self._metafunc = metafunc
+        self.fixturenames = fixturenames
+        self._arg2fixturedefs = _overlay(arg2fixturedefs, metafunc._arg2fixturedefs)
+        self._calls = calls
+
+        try:
+            self._ids = copy.copy(metafunc._ids)
+        except AttributeError:
+            # pytest>=5.3.0
+            pass
+
+    def __getattr__(self, name):
+        if name == '_metafunc':
+            raise AttributeError(name)
+
+        for klass in type(self._metafunc).__mro__:
+            if name in klass.__dict__:
+                attr = klass.__dict__[name]
+                if isinstance(attr, types.FunctionType):
+                    return types.MethodType(attr, self)
+                break
+        return getattr(self._metafunc, name)
+
+
+def _overlay(mapping, base):
+    if ChainMap is None:
+        # python 2; no `collections.ChainMap`
+        merged = dict(base)
+        merged.update(mapping)
+        return merged
+    # writes go to the first, fresh mapping; `mapping` is shared by the closure cache
+    return ChainMap({}, mapping, base)
+
+
+class FixtureClosureCache(object):
+    """Fixture closures of lazy fixtures computed during the collection.
+
+    The same lazy fixture is usually referenced by many callspecs of the same
+    test function, so its closure under the same parent node is computed once.
+    The cache is invalidated whenever a new plugin (e.g. conftest) is registered
+    because it can add or override fixtures.
+    """
+
+    def __init__(self):
+        self._closures = {}
+
+    def pytest_plugin_registered(self, plugin, manager):
+        self.clear()
+
+    def clear(self):
+        self._closures.clear()
+
+    def getfixtureclosure(self, fm, names, parentnode):
+        fixturedefs = [fm.getfixturedefs(name, parentnode.nodeid) or () for name in names]
+        key = (tuple(names), parentnode.nodeid, tuple(id(fixturedef) for defs in fixturedefs for fixturedef in defs))
+
+        try:
+            return self._closures[key]
+        except KeyError:
+            closure = self._closures[key] = _getfixtureclosure(fm, names, parentnode)
+            return closure
+
+
+class LazyFixtureProfiler(object):
+    """Resolution statistics of lazy fixtures, enabled by `--lazy-fixture-profile`.
+
+    For every fixture name it records how many times it was resolved, the
+    cumulative and the max time of `request.getfixturevalue` and how deep it
+    was nested in resolution of other lazy fixtures.
+    """
+
+    def __init__(self, top, json_path=None):
+        self.top = top
+        self.json_path = json_path
+        self.stats = {}
+        self._depth = 0
+
+    def getfixturevalue(self, request, name):
+        self._depth += 1
+        depth = self._depth
+        start = timeit.default_timer()
+        try:
+            return request.getfixturevalue(name)
+        finally:
+            elapsed = timeit.default_timer() - start
+            self._depth -= 1
+
+            stat = self.stats.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'depth': 0})
+            stat['count'] += 1
+            stat['total'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+            stat['depth'] = max(stat['depth'], depth)
+
+    def sorted_stats(self):
+        return sorted(self.stats.items(), key=lambda item: (-item[1]['total'], item[0]))
+
+    def pytest_sessionfinish(self, session):
+        if self.json_path is None:
+            return
+
+        fixtures = [dict(stat, name=name) for name, stat in self.sorted_stats()]
+        with open(self.json_path, 'w') as f:
+            json.dump({'fixtures': fixtures}, f, indent=2, sort_keys=True)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        stats = self.sorted_stats()[:self.top]
+        terminalreporter.write_sep('=', 'lazy fixture profile (top {})'.format(self.top))
+        if not stats:
+            terminalreporter.write_line('no lazy fixtures were resolved')
+            return
+
+        width = max(len('fixture'), max(len(name) for name, _ in stats))
+        row = '{:<{width}}  {:>8}  {:>10}  {:>10}  {:>5}'
+        terminalreporter.write_line(row.format('fixture', 'calls', 'total (s)', 'max (s)', 'depth', width=width))
+        for name, stat in stats:
+            terminalreporter.write_line(row.format(
+                name, stat['count'], '{:.4f}'.format(stat['total']), '{:.4f}'.format(stat['max']), stat['depth'],
+                width=width
+            ))
+        if self.json_path is not None:
+            terminalreporter.write_line('lazy fixture profile written to {}'.format(self.json_path))
+
+
+class LazyFixtureGraph(object):
+    """Graph of collected items, their lazy values and fixture closures.
+
+    Enabled by `--lazy-fixture-graph`. For every fixture it counts how many
+    times it is set up by the collected items, a fixture that is set up more
+    than once is marked as repeated: widening its scope may save that time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.items = []
+        self.fixtures = OrderedDict()
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_collection_modifyitems(self, session, config, items):
+        fm = session._fixturemanager
+        closure_cache = config.pluginmanager.get_plugin('lazy-fixture-closure-cache')
+        setups = defaultdict(set)
+
+        for item in items:
+            callspec = getattr(item, 'callspec', None)
+            if callspec is None or getattr(item, '_lazyfixture_plan', ()) is None:
+                continue
+
+            lazy = []
+            values = itertools.chain(callspec.params.items(), getattr(callspec, 'funcargs', {}).items())
+            for argname, val in values:
+                if not is_lazy_fixture(val):
+                    continue
+                fixturenames_closure, arg2fixturedefs = closure_cache.getfixtureclosure(fm, val._argnames, item.parent)
+                fixtures = []
+                for name in fixturenames_closure:
+                    if not arg2fixturedefs.get(name):
+                        continue
+                    fixture = self._add_fixture(name, arg2fixturedefs)
+                    fixtures.append(fixture['id'])
+                    scope = fixture['scope'] if fixture['scope'] in LAZY_FIXTURE_SCOPES else 'function'
+                    setups[fixture['id']].add((_scope_node(item, scope).nodeid, callspec.indices.get(name)))
+                lazy.append({'argname': argname, 'value': repr(val), 'uses': list(val._argnames), 'fixtures': fixtures})
+
+            if lazy:
+                self.items.append({'nodeid': item.nodeid, 'lazy': lazy})
+
+        for fixture_id, fixture in self.fixtures.items():
+            fixture['setups'] = len(setups[fixture_id])
+            fixture['repeated'] = fixture['setups'] > 1
+
+        with open(self.path, 'w') as f:
+            if self.path.endswith(('.dot', '.gv')):
+                f.write(self.to_dot())
+            else:
+                json.dump(self.to_json(), f, indent=2, sort_keys=True)
+
+    def _add_fixture(self, name, arg2fixturedefs):
+        fixturedef = arg2fixturedefs[name][-1]
+        fixture_id = '{}::{}'.format(fixturedef.baseid, name) if fixturedef.baseid else name
+        fixture = self.fixtures.get(fixture_id)
+        if fixture is None:
+            fixture = self.fixtures[fixture_id] = {
+                'id': fixture_id,
+                'name': name,
+                'scope': fixturedef.scope,
+                'dependencies': [argname for argname in fixturedef.argnames if arg2fixturedefs.get(argname)],
+            }
+        return fixture
 
-            extra_fixturenames = [fname for fname in fixturenames_closure
-                                  if fname not in callspec.params and fname not in callspec.funcargs]
+    def to_json(self):
+        fixtures = sorted(self.fixtures.values(), key=lambda fixture: (-fixture['setups'], fixture['id']))
+        return {'items': self.items, 'fixtures': fixtures}
 
-            newmetafunc = copy_metafunc(metafunc)
-            newmetafunc.fixturenames = extra_fixturenames
-            newmetafunc._arg2fixturedefs.update(arg2fixturedefs)
-            newmetafunc._calls = [callspec]
-            fm.pytest_generate_tests(newmetafunc)
-            normalize_metafunc_calls(newmetafunc, valtype, used_keys | set([arg]))
-            return newmetafunc._calls
+    def to_dot(self):
+        lines = ['digraph lazy_fixtures {', '    rankdir=LR;']
+        for fixture_id, fixture in self.fixtures.items():
+            lines.append('    {} [shape=ellipse, label={}{}];'.format(
+                _dot_quote(fixture_id),
+                _dot_quote('{}\\n{}, {} setups'.format(fixture['name'], fixture['scope'], fixture['setups'])),
+                ', color=red, fontcolor=red' if fixture['repeated'] else ''
+            ))
+            for dependency in fixture['dependencies']:
+                for dependency_id in self._fixture_ids(dependency):
+                    lines.append('    {} -> {};'.format(_dot_quote(fixture_id), _dot_quote(dependency_id)))
 
-        used_keys.add(arg)
-    return [callspec]
+        for item in self.items:
+            lines.append('    {} [shape=box];'.format(_dot_quote(item['nodeid'])))
+            for lazy in item['lazy']:
+                lines.append('    {} -> {} [label={}];'.format(
+                    _dot_quote(item['nodeid']), _dot_quote(lazy['value']), _dot_quote(lazy['argname'])
+                ))
+                for fixture_id in lazy['fixtures']:
+                    if self.fixtures[fixture_id]['name'] in lazy['uses']:
+                        lines.append('    {} -> {};'.format(_dot_quote(lazy['value']), _dot_quote(fixture_id)))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def _fixture_ids(self, name):
+        return [fixture_id for fixture_id, fixture in self.fixtures.items() if fixture['name'] == name]
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_line('lazy fixture graph written to {}'.format(self.path))
+
+
+def _dot_quote(value):
+    return '"{}"'.format(value.replace('"', '\\"'))
+
+
+def _getfixtureclosure(fm, names, parentnode):
+    closure = fm.getfixtureclosure(list(names), parentnode)
+    if len(closure) == 2:
+        # 3.6.0 <= pytest < 3.7.0; `FixtureManager.getfixtureclosure` returns 2 values
+        return closure
+    _, fixturenames_closure, arg2fixturedefs = closure
+    return fixturenames_closure, arg2fixturedefs
+
+
+def attach_resolution_plans(items):
+    """Precompute `resolution_plan` and lazy funcargs of every parametrized item.
+
+    Items generated from the same function mostly share the shape of their
+    params, so a plan is computed once per shape and shared between them.
+    """
+    plans = {}
+    for item in items:
+        callspec = getattr(item, 'callspec', None)
+        fixturenames = getattr(item, 'fixturenames', None)
+        if callspec is None or fixturenames is None:
+            continue
+
+        item._lazyfixture_funcargs = tuple(
+            arg for arg, val in getattr(callspec, 'funcargs', {}).items() if is_lazy_fixture(val)
+        )
+
+        shape = (
+            tuple(fixturenames),
+            tuple((key, val._argnames if is_lazy_fixture(val) else None) for key, val in callspec.params.items())
+        )
+        plan = plans.get(shape)
+        if plan is None:
+            plan = plans[shape] = resolution_plan(callspec.params, fixturenames)
+        item._lazyfixture_plan = plan
+
+
+def resolution_plan(params, fixturenames):
+    """Return the order in which arguments of an item are resolved.
+
+    It is a tuple of `(argname, is_lazy)` pairs sorted by dependency.
+    """
+    return tuple(
+        (key, val is not None and is_lazy_fixture(val))
+        for key, val in sorted_by_dependency(params, fixturenames)
+    )
+
+
+def reorder_items(items):
+    """Group items by the higher-scoped fixtures their lazy values resolve to.
+
+    Items that use different params of the same fixture are in different
+    groups, so the fixture is not torn down and set up again between them.
+    Items are only moved within consecutive items of the same parent that
+    share the params of higher-scoped fixtures the items request themselves,
+    so the order pytest chose for classes, modules and those fixtures is kept.
+    The group that continues the previous run's last group runs first.
+    """
+    reordered = []
+    last_key = None
+    for _, run in itertools.groupby(items, key=lambda item: (item.parent, param_scope_key(item))):
+        groups = OrderedDict()
+        for item in run:
+            groups.setdefault(lazy_fixture_scope_key(item), []).append(item)
+
+        if last_key in groups:
+            reordered.extend(groups.pop(last_key))
+        for key, group in groups.items():
+            reordered.extend(group)
+            last_key = key
+    return reordered
+
+
+def param_scope_key(item):
+    """Return params of higher-scoped fixtures that `item` requests itself.
+
+    pytest already groups items by them, it is a sorted tuple of
+    `(name, param_index)` pairs like `lazy_fixture_scope_key`.
+    """
+    callspec = getattr(item, 'callspec', None)
+    if callspec is None:
+        return ()
+
+    name2fixturedefs = item._fixtureinfo.name2fixturedefs
+    return tuple(sorted(
+        (name, index) for name, index in callspec.indices.items()
+        if name in item.fixturenames and name in name2fixturedefs and name2fixturedefs[name][-1].scope != 'function'
+    ))
+
+
+class XdistGroupMarker(object):
+    """Mark items with `xdist_group`, enabled by `--lazy-fixture-xdist-group`.
+
+    Items whose lazy values use the same higher-scoped fixtures share a group,
+    so with `--dist=loadgroup` every such fixture is set up on one worker only.
+    It runs before xdist turns the markers into node id suffixes.
+    """
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collection_modifyitems(self, session, config, items):
+        for item in items:
+            if item.get_closest_marker('xdist_group') is not None:
+                continue
+            names = sorted(set(name for name, _ in lazy_fixture_scope_key(item)))
+            if names:
+                item.add_marker(pytest.mark.xdist_group(name='lazy_fixture:' + ','.join(names)))
+
+
+def lazy_fixture_scope_key(item):
+    """Return higher-scoped fixtures that lazy values of `item` use.
+
+    It is a sorted tuple of `(name, param_index)` pairs, the index is None
+    for fixtures that are not parametrized.
+    """
+    callspec = getattr(item, 'callspec', None)
+    if callspec is None or getattr(item, '_lazyfixture_plan', ()) is None:
+        return ()
+
+    lazy_values = [
+        val for val in itertools.chain(callspec.params.values(), getattr(callspec, 'funcargs', {}).values())
+        if is_lazy_fixture(val)
+    ]
+    if not lazy_values:
+        return ()
+
+    fm = item.session._fixturemanager
+    closure_cache = item.config.pluginmanager.get_plugin('lazy-fixture-closure-cache')
+    names = set()
+    for val in lazy_values:
+        _, arg2fixturedefs = closure_cache.getfixtureclosure(fm, val._argnames, item.parent)
+        names.update(
+            name for name, fixturedefs in arg2fixturedefs.items()
+            if fixturedefs[-1].scope != 'function' and name not in item.fixturenames
+        )
+    return tuple(sorted((name, callspec.indices.get(name)) for name in names))
 
 
 def sorted_by_dependency(params, fixturenames):
     free_fm = []
     non_free_fm = defaultdict(list)
+    parents_count = {}
+    all_parents = {}
 
     for key in _sorted_argnames(params, fixturenames):
         val = params.get(key)
+        parents = [name for name in val._argnames if name in params] if is_lazy_fixture(val) else []
 
-        if key not in params or not is_lazy_fixture(val) or val.name not in params:
+        if key not in params or not parents:
             free_fm.append(key)
         else:
-            non_free_fm[val.name].append(key)
+            for parent in parents:
+                non_free_fm[parent].append(key)
+            parents_count[key] = len(parents)
+            all_parents[key] = parents
 
     non_free_fm_list = []
     for free_key in free_fm:
         non_free_fm_list.extend(
-            _tree_to_list(non_free_fm, free_key)
+            _tree_to_list(non_free_fm, free_key, parents_count)
+        )
+
+    if len(non_free_fm_list) < len(parents_count):
+        unresolved = set(key for key, count in parents_count.items() if count)
+        pytest.fail(
+            'lazy fixtures depend on each other in a cycle: {}'.format(
+                ' -> '.join(_find_cycle(all_parents, unresolved))
+            ),
+            pytrace=False
         )
 
     return [(key, params.get(key)) for key in (free_fm + non_free_fm_list)]
 
 
+def _find_cycle(all_parents, unresolved):
+    """Return a cycle of keys in `unresolved`, each followed by the key it depends on.
+
+    Every unresolved key depends on another unresolved one, so following these
+    dependencies from any of them ends in a cycle.
+    """
+    path = [min(unresolved)]
+    positions = {path[0]: 0}
+    while True:
+        parent = min(parent for parent in all_parents[path[-1]] if parent in unresolved)
+        if parent in positions:
+            return path[positions[parent]:] + [parent]
+        positions[parent] = len(path)
+        path.append(parent)
+
+
 def _sorted_argnames(params, fixturenames):
     argnames = set(params.keys())
 
@@ -165,35 +1427,193 @@ def _sorted_argnames(params, fixturenames):
             yield name
 
 
-def _tree_to_list(trees, leave):
+def _tree_to_list(trees, leave, parents_count):
+    """Walk dependents of `leave` depth-first.
+
+    A key that depends on several others is listed after the last of them.
+    """
     lst = []
-    for l in trees[leave]:
-        lst.append(l)
-        lst.extend(
-            _tree_to_list(trees, l)
-        )
+    stack = [iter(trees[leave])]
+    while stack:
+        key = next(stack[-1], None)
+        if key is None:
+            stack.pop()
+            continue
+
+        parents_count[key] -= 1
+        if parents_count[key] == 0:
+            lst.append(key)
+            stack.append(iter(trees[key]))
     return lst
 
 
-def lazy_fixture(names):
+def lazy_fixture(names, scope=None):
+    """Reference fixtures in parametrize values.
+
+    `names` is a fixture name, a list of them, or a callable. Arguments of the
+    callable are resolved as fixtures when the test is set up and its return
+    value is used instead.
+
+    With `scope` the resolved value is computed once per node of that scope
+    and reused until the node is torn down.
+    """
+    if scope is not None and scope not in LAZY_FIXTURE_SCOPES:
+        raise ValueError('lazy_fixture scope must be one of {}, got {!r}'.format(', '.join(LAZY_FIXTURE_SCOPES), scope))
+
     if isinstance(names, string_type):
-        return LazyFixture(names)
+        return LazyFixture(names, scope=scope)
+    elif callable(names):
+        return LazyFixture(getattr(names, '__name__', repr(names)), func=names, scope=scope)
     else:
-        return [LazyFixture(name) for name in names]
+        return [LazyFixture(name, scope=scope) for name in names]
 
 
 def is_lazy_fixture(val):
-    return isinstance(val, LazyFixture)
+    return isinstance(val, (LazyFixture, LazyContainer))
 
 
 class LazyFixture(object):
-    def __init__(self, name):
-        self.name = name
+    """Reference to a fixture by its name, or to a callable of fixtures.
+
+    Attributes taken with `attr` and indexing are recorded and applied to the
+    fixture value when it is resolved, e.g. `lazy_fixture('dataset')['train'].attr('rows')`.
+
+    Instances are interned, so all references to the same fixture share one
+    immutable object which can be used as a dict key.
+    """
+
+    __slots__ = ('name', 'scope', '_path', '_func', '_argnames', '_id', '__weakref__')
+
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, name, path=(), func=None, scope=None):
+        key = (cls, name, path, func, scope)
+        try:
+            return cls._instances[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable index, e.g. a slice; such references are not interned
+            key = None
+
+        self = super(LazyFixture, cls).__new__(cls)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'scope', scope)
+        object.__setattr__(self, '_path', path)
+        object.__setattr__(self, '_func', func)
+        object.__setattr__(self, '_argnames', (name,) if func is None else tuple(getfuncargnames(func)))
+        if key is not None:
+            cls._instances[key] = self
+        return self
+
+    def attr(self, name):
+        """Return a reference to attribute `name` of the fixture value."""
+        return self.__class__(self.name, self._path + (('attr', name),), self._func, self.scope)
+
+    def __getitem__(self, key):
+        return self.__class__(self.name, self._path + (('item', key),), self._func, self.scope)
+
+    # `__getitem__` would otherwise make instances endlessly iterable
+    __iter__ = None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("can't set attribute {!r} of {!r}".format(name, self))
+
+    def __delattr__(self, name):
+        raise AttributeError("can't delete attribute {!r} of {!r}".format(name, self))
 
     def __repr__(self):
-        return '<{} "{}">'.format(self.__class__.__name__, self.name)
+        name = self.name if self._func is None else '{}({})'.format(self.name, ', '.join(self._argnames))
+        path = ''.join('.{}'.format(key) if kind == 'attr' else '[{!r}]'.format(key) for kind, key in self._path)
+        return '<{} "{}{}">'.format(self.__class__.__name__, name, path)
 
     def __eq__(self, other):
         if isinstance(other, LazyFixture):
-            return self.name == other.name
+            return (self.name == other.name and self._path == other._path and
+                    self._func == other._func and self.scope == other.scope)
         return NotImplemented
+
+    def __hash__(self):
+        try:
+            return hash((self.name, self._path, self._func, self.scope))
+        except TypeError:
+            return hash(self.name)
+
+    def __reduce__(self):
+        return self.__class__, (self.name, self._path, self._func, self.scope)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class LazyContainer(object):
+    """Tuple, list, dict or dataclass value that contains lazy fixtures.
+
+    `tree` holds the paths to the lazy fixtures inside `value`, computed by
+    `lazy_leaves` at collection, so resolving it only rebuilds the containers
+    on those paths. `value` itself is not modified.
+    """
+
+    __slots__ = ('value', 'tree', 'scope', '_argnames')
+
+    def __init__(self, value, tree):
+        self.value = value
+        self.tree = tree
+        self.scope = None
+        argnames = OrderedDict()
+        for leaf in self.leaves():
+            argnames.update((argname, None) for argname in leaf._argnames)
+        self._argnames = tuple(argnames)
+
+    def leaves(self):
+        stack = [(self.value, self.tree)]
+        while stack:
+            value, tree = stack.pop()
+            for key, subtree in tree.items():
+                child = _get_child(value, key)
+                if subtree is None:
+                    yield child
+                else:
+                    stack.append((child, subtree))
+
+    def resolve(self, resolve_leaf):
+        return _replace_leaves(self.value, self.tree, resolve_leaf)
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, self.value)
+
+
+def _get_child(value, key):
+    if isinstance(value, (tuple, list, dict)):
+        return value[key]
+    return getattr(value, key)
+
+
+def _replace_leaves(value, tree, resolve_leaf):
+    children = dict(
+        (key, resolve_leaf(_get_child(value, key)) if subtree is None else
+         _replace_leaves(_get_child(value, key), subtree, resolve_leaf))
+        for key, subtree in tree.items()
+    )
+
+    if isinstance(value, dict):
+        new = value.copy()
+        new.update(children)
+        return new
+    if isinstance(value, list):
+        new = list(value)
+        for key, child in children.items():
+            new[key] = child
+        return new
+    if isinstance(value, tuple):
+        items = [children.get(i, item) for i, item in enumerate(value)]
+        return value._make(items) if hasattr(value, '_fields') else tuple(items)
+
+    new = copy.copy(value)
+    for key, child in children.items():
+        # frozen dataclasses forbid setattr
+        object.__setattr__(new, key, child)
+    return new
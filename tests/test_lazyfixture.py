@@ -1,11 +1,24 @@
 # -*- coding: utf-8 -*-
+import copy
+import json
+import pickle
+import sys
+import textwrap
+import threading
 import pytest
-from pytest_lazyfixture import sorted_by_dependency, lazy_fixture, _sorted_argnames
+from pytest_lazyfixture import (
+    sorted_by_dependency, lazy_fixture, lazy_leaves, _sorted_argnames, _ThreadLocalVar, MetafuncView,
+    normalize_metafunc_calls, pytest_make_parametrize_id
+)
 
 try:
     import numpy
 except ImportError:
     numpy = None
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 
 
 def test_fixture_in_parametrize_with_params(testdir):
@@ -936,3 +949,1622 @@ def test_eq():
     assert lazy_fixture("Lol") == lazy_fixture("Lol")
     assert lazy_fixture("Lol") != lazy_fixture("Wut")
     assert lazy_fixture("Lol") != 123
+
+
+def test_fixture_closure_is_computed_once_per_parent(testdir, monkeypatch):
+    from _pytest.fixtures import FixtureManager
+
+    calls = []
+    getfixtureclosure = FixtureManager.getfixtureclosure
+
+    def counting_getfixtureclosure(self, fixturenames, *args, **kwargs):
+        calls.append(list(fixturenames))
+        return getfixtureclosure(self, fixturenames, *args, **kwargs)
+
+    monkeypatch.setattr(FixtureManager, 'getfixtureclosure', counting_getfixtureclosure)
+    items, _ = testdir.inline_genitems(testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('one')] * 5)
+        def test_func(arg):
+            pass
+    """))
+    assert len(items) == 10
+    assert calls.count(['one']) == 1
+
+
+def test_fixture_closure_cache_respects_conftest_overrides(testdir):
+    testdir.makepyfile(test_root="""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('one')])
+        def test_func(arg):
+            assert arg in [1, 2]
+    """)
+    sub = testdir.mkpydir('sub')
+    sub.join('conftest.py').write(textwrap.dedent("""
+        import pytest
+
+        @pytest.fixture(params=[3, 4, 5])
+        def one(request):
+            return request.param
+    """))
+    sub.join('test_sub.py').write(textwrap.dedent("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('one')])
+        def test_func(arg):
+            assert arg in [3, 4, 5]
+    """))
+    result = testdir.inline_run()
+    result.assertoutcome(passed=5)
+
+
+def test_many_lazy_fixtures_in_one_callspec(testdir):
+    count = 600
+    argnames = ['arg{}'.format(i) for i in range(count)]
+    items = testdir.getitems("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+
+        @pytest.mark.parametrize({argnames!r}, [[lazy_fixture('one')] * {count}])
+        def test_func({args}):
+            pass
+    """.format(argnames=','.join(argnames), count=count, args=', '.join(argnames)))
+    assert len(items) == 2
+    assert [item.callspec.params['one'] for item in items] == [1, 2]
+
+
+def test_lazy_fixtures_expansion_order(testdir):
+    items = testdir.getitems("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+
+        @pytest.fixture(params=[3, 4])
+        def two(request):
+            return request.param
+
+        @pytest.mark.parametrize('arg1,arg2', [
+            (lazy_fixture('one'), lazy_fixture('two')),
+            ('val1', lazy_fixture('two')),
+        ])
+        def test_func(arg1, arg2):
+            pass
+    """)
+    assert [item.name for item in items] == [
+        'test_func[one-two-1-3]',
+        'test_func[one-two-1-4]',
+        'test_func[one-two-2-3]',
+        'test_func[one-two-2-4]',
+        'test_func[val1-two-3]',
+        'test_func[val1-two-4]',
+    ]
+
+
+def test_lazy_fixtures_mixed_with_many_plain_callspecs(testdir):
+    items = testdir.getitems("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+
+        @pytest.mark.parametrize('arg', [
+            lazy_fixture('one') if i % 1000 == 500 else i for i in range(5000)
+        ])
+        def test_func(arg):
+            pass
+    """)
+    assert len(items) == 5005
+    assert [item.callspec.params.get('one') for item in items[499:503]] == [None, 1, 2, None]
+    assert items[502].callspec.params['arg'] == 501
+
+
+def test_normalize_keeps_calls_without_lazy_values():
+    class CallSpec(object):
+        def __init__(self, params):
+            self.params = params
+            self.funcargs = {}
+
+    class Metafunc(object):
+        _calls = [CallSpec({'arg': i}) for i in range(3)]
+
+    calls = Metafunc._calls
+    normalize_metafunc_calls(Metafunc, 'params')
+    assert Metafunc._calls is calls
+
+
+def test_normalize_does_not_change_original_calls(testdir):
+    testdir.makeconftest("""
+        import pytest
+
+        parametrized = []
+
+        @pytest.hookimpl(hookwrapper=True, trylast=True)
+        def pytest_generate_tests(metafunc):
+            yield
+            parametrized.append(metafunc._calls)
+
+        def pytest_collection_modifyitems(items):
+            assert [len(calls) for calls in parametrized] == [3]
+            assert None not in parametrized[0]
+    """)
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+
+        @pytest.mark.parametrize('arg', [0, lazy_fixture('one'), 3])
+        def test_func(arg):
+            pass
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=4)
+
+
+def test_metafunc_view_does_not_change_metafunc():
+    class Metafunc(object):
+        def __init__(self):
+            self.fixturenames = ['a']
+            self._arg2fixturedefs = {'a': 'a-def'}
+            self._calls = []
+            self.config = 'config'
+
+        def parametrize(self, call):
+            self._calls.append(call)
+
+    metafunc = Metafunc()
+    arg2fixturedefs = {'b': 'b-def'}
+    view = MetafuncView(metafunc, ['b'], arg2fixturedefs, ['call'])
+    view.parametrize('newcall')
+    view._arg2fixturedefs['c'] = 'c-def'
+
+    assert view._calls == ['call', 'newcall']
+    assert view.fixturenames == ['b']
+    assert view.config == 'config'
+    assert view._arg2fixturedefs['a'] == 'a-def'
+    assert view._arg2fixturedefs['b'] == 'b-def'
+    assert metafunc._calls == []
+    assert metafunc.fixturenames == ['a']
+    assert metafunc._arg2fixturedefs == {'a': 'a-def'}
+    assert arg2fixturedefs == {'b': 'b-def'}
+
+
+def test_resolution_plan_is_attached_at_collection(testdir):
+    items = testdir.getitems("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def one():
+            return 1
+
+        @pytest.mark.parametrize('arg1,arg2', [
+            (lazy_fixture('one'), lazy_fixture('arg1')),
+            (lazy_fixture('one'), lazy_fixture('arg1')),
+        ])
+        def test_func(arg1, arg2):
+            pass
+    """)
+    assert len(items) == 2
+    assert items[0]._lazyfixture_plan == (('arg1', True), ('arg2', True))
+    assert items[0]._lazyfixture_plan is items[1]._lazyfixture_plan
+
+
+def test_no_resolution_plan_without_lazy_values(testdir):
+    testdir.makeconftest("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def one():
+            return 1
+
+        @pytest.fixture(params=[lazy_fixture('one')])
+        def some(request):
+            return request.param
+    """)
+    items = testdir.getitems("""
+        import pytest
+
+        @pytest.mark.parametrize('arg', [1, 2])
+        def test_plain(arg):
+            pass
+
+        def test_fixture_param(some):
+            pass
+
+        class TestClass(object):
+            @pytest.mark.parametrize('arg', [1])
+            def test_method(self, arg, some):
+                pass
+    """)
+    assert [item._lazyfixture_plan is None for item in items] == [True, True, False, False]
+    assert ('some', True) in items[3]._lazyfixture_plan
+
+
+@pytest.mark.parametrize('reorder', [False, True])
+def test_reorder_items_by_lazy_higher_scoped_fixtures(testdir, reorder):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(scope='session')
+        def pg():
+            return 'pg'
+
+        @pytest.fixture(scope='session')
+        def mysql():
+            return 'mysql'
+
+        @pytest.fixture
+        def sqlite():
+            return 'sqlite'
+
+        @pytest.mark.parametrize('db', [lazy_fixture('pg'), lazy_fixture('mysql'), lazy_fixture('sqlite')])
+        @pytest.mark.parametrize('x', [1, 2])
+        def test_func(db, x):
+            pass
+    """)
+    args = ['--lazy-fixture-reorder'] if reorder else []
+    result = testdir.runpytest('--collect-only', '-q', *args)
+    names = [line.split('::')[-1] for line in result.outlines if '::' in line]
+    if reorder:
+        assert names == [
+            'test_func[1-pg]', 'test_func[2-pg]',
+            'test_func[1-mysql]', 'test_func[2-mysql]',
+            'test_func[1-sqlite]', 'test_func[2-sqlite]',
+        ]
+    else:
+        assert names == [
+            'test_func[1-pg]', 'test_func[1-mysql]', 'test_func[1-sqlite]',
+            'test_func[2-pg]', 'test_func[2-mysql]', 'test_func[2-sqlite]',
+        ]
+
+
+@pytest.mark.parametrize('reorder', [False, True])
+def test_reorder_items_keeps_params_of_higher_scoped_fixtures_together(testdir, reorder):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        setups = []
+
+        @pytest.fixture(scope='module', params=[1, 2])
+        def db(request):
+            setups.append(request.param)
+            return request.param
+
+        @pytest.fixture(scope='module')
+        def cache():
+            return 'cache'
+
+        @pytest.fixture
+        def both(db, cache):
+            return db
+
+        @pytest.mark.parametrize('res', [lazy_fixture('db'), lazy_fixture('both')])
+        def test_func(res):
+            pass
+
+        def test_setups():
+            assert setups == [1, 2]
+    """)
+    args = ['--lazy-fixture-reorder'] if reorder else []
+    reprec = testdir.inline_run('-s', *args)
+    reprec.assertoutcome(passed=5)
+
+
+@pytest.mark.parametrize('reorder', [False, True])
+def test_reorder_items_keeps_params_of_requested_higher_scoped_fixtures_together(testdir, reorder):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        setups = []
+
+        @pytest.fixture(scope='module', params=[1, 2])
+        def db(request):
+            setups.append(request.param)
+            return request.param
+
+        @pytest.fixture(scope='module')
+        def pg():
+            return 'pg'
+
+        @pytest.fixture(scope='module')
+        def mysql():
+            return 'mysql'
+
+        @pytest.mark.parametrize('engine', [lazy_fixture('pg'), lazy_fixture('mysql')])
+        def test_x(db, engine):
+            pass
+
+        def test_setups():
+            assert setups == [1, 2]
+    """)
+    args = ['--lazy-fixture-reorder'] if reorder else []
+    result = testdir.runpytest('-v', *args)
+    result.assert_outcomes(passed=5)
+    names = [line.split('::')[-1].split()[0] for line in result.outlines if 'PASSED' in line]
+    if reorder:
+        assert names[:4] == ['test_x[1-pg]', 'test_x[1-mysql]', 'test_x[2-mysql]', 'test_x[2-pg]']
+    else:
+        assert names[:4] == ['test_x[1-pg]', 'test_x[1-mysql]', 'test_x[2-pg]', 'test_x[2-mysql]']
+
+
+def test_lazy_fixture_profile(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def one():
+            return 1
+
+        @pytest.fixture(params=[lazy_fixture('one')])
+        def two(request):
+            return request.param + 1
+
+        @pytest.mark.parametrize('arg1,arg2', [
+            (lazy_fixture('one'), lazy_fixture('two')),
+            (lazy_fixture('one'), 2),
+        ])
+        def test_func(arg1, arg2):
+            assert (arg1, arg2) == (1, 2)
+    """)
+    profile = testdir.tmpdir.join('profile.json')
+    result = testdir.runpytest('--lazy-fixture-profile-json', str(profile))
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines([
+        '*lazy fixture profile (top 10)*',
+        'fixture *calls *total (s) *max (s) *depth',
+        'one *2 *',
+        'two *1 *',
+    ])
+
+    fixtures = {stat['name']: stat for stat in json.loads(profile.read())['fixtures']}
+    # the lazy param of `two` reuses the value of `one` looked up for `arg1`
+    assert fixtures['one']['count'] == 2
+    assert fixtures['one']['depth'] == 1
+    assert fixtures['two']['count'] == 1
+    assert fixtures['two']['depth'] == 1
+    assert fixtures['two']['total'] >= fixtures['two']['max'] > 0
+
+
+def test_lazy_fixture_profile_is_disabled_by_default(testdir):
+    testdir.makepyfile("""
+        def test_func():
+            pass
+    """)
+    result = testdir.runpytest()
+    assert 'lazy fixture profile' not in result.stdout.str()
+
+
+def test_lazy_fixture_is_interned_and_hashable():
+    assert lazy_fixture('one') is lazy_fixture('one')
+    assert lazy_fixture(['one', 'two']) == [lazy_fixture('one'), lazy_fixture('two')]
+    assert lazy_fixture(['one', 'two'])[0] is lazy_fixture('one')
+    assert hash(lazy_fixture('one')) == hash(lazy_fixture('one'))
+    assert len({lazy_fixture('one'), lazy_fixture('one'), lazy_fixture('two')}) == 2
+    assert not hasattr(lazy_fixture('one'), '__dict__')
+
+
+def test_lazy_fixture_copy_and_pickle_keep_identity():
+    val = lazy_fixture('one')
+    assert copy.copy(val) is val
+    assert copy.deepcopy([val])[0] is val
+    assert pickle.loads(pickle.dumps(val)) is val
+
+
+def test_fillfixtures_is_installed_once_per_session(testdir):
+    from _pytest.fixtures import FixtureRequest
+    import pytest_lazyfixture
+
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def one():
+            return 1
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('one')])
+        def test_func(request, arg):
+            assert arg == 1
+            assert '_fillfixtures' not in vars(request)
+            assert request._pyfuncitem._lazyfixture_funcargs == ()
+    """)
+    installs = len(pytest_lazyfixture._fillfixtures_installs)
+    fill = FixtureRequest._fillfixtures
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=1)
+    assert len(pytest_lazyfixture._fillfixtures_installs) == installs
+    assert FixtureRequest._fillfixtures is fill
+
+
+def test_xdist_group_markers(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(scope='session')
+        def pg():
+            return 'pg'
+
+        @pytest.fixture(scope='module')
+        def mysql():
+            return 'mysql'
+
+        @pytest.fixture
+        def sqlite():
+            return 'sqlite'
+
+        @pytest.mark.parametrize('db', [lazy_fixture('pg'), lazy_fixture('mysql'), lazy_fixture('sqlite')])
+        def test_func(db):
+            pass
+
+        @pytest.mark.xdist_group(name='custom')
+        @pytest.mark.parametrize('db', [lazy_fixture('pg')])
+        def test_custom(db):
+            pass
+    """)
+    items, _ = testdir.inline_genitems('--lazy-fixture-xdist-group')
+    groups = dict(
+        (item.name, item.get_closest_marker('xdist_group') and item.get_closest_marker('xdist_group').kwargs['name'])
+        for item in items
+    )
+    assert groups == {
+        'test_func[pg]': 'lazy_fixture:pg',
+        'test_func[mysql]': 'lazy_fixture:mysql',
+        'test_func[sqlite]': None,
+        'test_custom[pg]': 'custom',
+    }
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='async generators are needed')
+def test_async_lazy_fixtures_are_gathered(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_gather_async = true
+    """)
+    testdir.makepyfile("""
+        import asyncio
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        started = []
+        events = []
+
+        async def wait_for(name):
+            for _ in range(100):
+                if name in started:
+                    return
+                await asyncio.sleep(0.01)
+            raise AssertionError('{} was not set up concurrently'.format(name))
+
+        @pytest.fixture
+        def base():
+            return 'base'
+
+        @pytest.fixture
+        async def one(base):
+            started.append('one')
+            await wait_for('two')
+            return base + '-one'
+
+        @pytest.fixture
+        async def two():
+            started.append('two')
+            await wait_for('one')
+            yield 'two'
+            events.append('teardown two')
+
+        @pytest.fixture
+        async def three():
+            yield 'three'
+            events.append('teardown three')
+
+        @pytest.mark.parametrize('arg1,arg2,arg3', [
+            (lazy_fixture('one'), lazy_fixture('two'), lazy_fixture('three')),
+        ])
+        def test_func(arg1, arg2, arg3):
+            assert (arg1, arg2, arg3) == ('base-one', 'two', 'three')
+
+        def test_teardown():
+            assert events == ['teardown three', 'teardown two']
+    """)
+    reprec = testdir.inline_run('-s')
+    reprec.assertoutcome(passed=2)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='async generators are needed')
+def test_async_lazy_fixtures_are_gathered_with_pytest_asyncio(testdir):
+    pytest.importorskip('pytest_asyncio')
+    testdir.makeini("""
+        [pytest]
+        asyncio_mode = strict
+        lazy_fixture_gather_async = true
+    """)
+    testdir.makepyfile("""
+        import asyncio
+        import pytest
+        import pytest_asyncio
+        from pytest_lazyfixture import lazy_fixture
+
+        started = []
+        loops = []
+        events = []
+
+        async def wait_for(name):
+            for _ in range(100):
+                if name in started:
+                    return
+                await asyncio.sleep(0.01)
+            raise AssertionError('{} was not set up concurrently'.format(name))
+
+        @pytest_asyncio.fixture
+        async def one():
+            started.append('one')
+            loops.append(asyncio.get_running_loop())
+            await wait_for('two')
+            return 'one'
+
+        @pytest_asyncio.fixture
+        async def two():
+            started.append('two')
+            loops.append(asyncio.get_running_loop())
+            await wait_for('one')
+            yield
+            events.append('teardown two')
+
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('one'), lazy_fixture('two'))])
+        def test_func(arg1, arg2):
+            assert (arg1, arg2) == ('one', None)
+
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('one'), lazy_fixture('two'))])
+        def test_event_loop(arg1, arg2, event_loop):
+            assert loops[-2:] == [event_loop, event_loop]
+
+        def test_teardown():
+            assert events == ['teardown two', 'teardown two']
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=3)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='async generators are needed')
+def test_single_async_lazy_fixture_is_awaited(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_gather_async = true
+    """)
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        events = []
+
+        @pytest.fixture
+        async def one():
+            events.append('setup one')
+            return 1
+
+        @pytest.fixture
+        async def empty():
+            events.append('setup empty')
+            yield
+            events.append('teardown empty')
+
+        @pytest.mark.parametrize('arg,expected', [(lazy_fixture('one'), 1), (lazy_fixture('empty'), None)])
+        def test_func(arg, expected):
+            assert arg == expected
+
+        def test_events():
+            assert events == ['setup one', 'setup empty', 'teardown empty']
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=3)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='async generators are needed')
+def test_async_lazy_fixture_errors_are_raised_at_setup(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_gather_async = true
+    """)
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        async def one():
+            raise ValueError('broken one')
+
+        @pytest.fixture
+        async def two():
+            return 2
+
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('one'), lazy_fixture('two'))])
+        def test_func(arg1, arg2):
+            pass
+    """)
+    result = testdir.runpytest()
+    # `assert_outcomes` takes `error` instead of `errors` on pytest < 6.0.0
+    result.stdout.fnmatch_lines(['*ValueError: broken one*', '*1 error*'])
+
+
+THREADED_FIXTURES = """
+    import threading
+    import pytest
+    from pytest_lazyfixture import lazy_fixture
+
+    barrier = threading.Barrier(2, timeout=5)
+    events = []
+
+    @pytest.fixture(scope='module')
+    def base():
+        return 'base'
+
+    @pytest.fixture
+    def one(base):
+        barrier.wait()
+        yield base + '-one'
+        events.append('teardown one')
+
+    @pytest.fixture
+    def two():
+        barrier.wait()
+        yield 'two'
+        events.append('teardown two')
+
+    {marker}
+    @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('one'), lazy_fixture('two'))])
+    def test_func(arg1, arg2):
+        assert (arg1, arg2) == ('base-one', 'two')
+
+    def test_teardown():
+        assert events == ['teardown two', 'teardown one']
+"""
+
+
+@pytest.mark.skipif(sys.version_info < (3, 2), reason='threading.Barrier is needed')
+def test_lazy_fixtures_are_set_up_in_threads(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_threads = 2
+    """)
+    testdir.makepyfile(THREADED_FIXTURES.format(marker=''))
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=2)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 2), reason='threading.Barrier is needed')
+@pytest.mark.parametrize('marker', ['lazy_fixture_threads(2)', 'lazy_fixture_threads(n=2)'])
+def test_lazy_fixtures_threads_marker(testdir, marker):
+    testdir.makepyfile(THREADED_FIXTURES.format(marker='@pytest.mark.' + marker))
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=2)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4), reason='threading.main_thread is needed')
+@pytest.mark.parametrize('marker', ['lazy_fixture_threads(0)', 'lazy_fixture_threads(n=0)'])
+def test_lazy_fixtures_threads_marker_disables_threads(testdir, marker):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_threads = 2
+    """)
+    testdir.makepyfile("""
+        import threading
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def one():
+            return threading.current_thread()
+
+        @pytest.fixture
+        def two():
+            return threading.current_thread()
+
+        @pytest.mark.%s
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('one'), lazy_fixture('two'))])
+        def test_func(arg1, arg2):
+            assert arg1 is arg2 is threading.main_thread()
+    """ % marker)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=1)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 2), reason='threading.Barrier is needed')
+def test_lazy_fixtures_in_threads_returning_none(testdir):
+    testdir.makepyfile("""
+        import threading
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        barrier = threading.Barrier(2, timeout=5)
+        events = []
+
+        @pytest.fixture
+        def one():
+            barrier.wait()
+            events.append('setup one')
+            yield
+            events.append('teardown one')
+
+        @pytest.fixture
+        def two():
+            barrier.wait()
+            events.append('setup two')
+
+        @pytest.mark.lazy_fixture_threads(2)
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('one'), lazy_fixture('two'))])
+        def test_func(arg1, arg2):
+            assert (arg1, arg2) == (None, None)
+
+        def test_events():
+            assert sorted(events[:2]) == ['setup one', 'setup two']
+            assert events[2:] == ['teardown one']
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=2)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4), reason='threading.main_thread is needed')
+def test_higher_scoped_lazy_fixtures_are_not_set_up_in_threads(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_threads = 2
+    """)
+    testdir.makepyfile("""
+        import threading
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def narrow():
+            return 'narrow'
+
+        @pytest.fixture(scope='module')
+        def one():
+            return threading.current_thread()
+
+        @pytest.fixture(scope='module')
+        def two():
+            return threading.current_thread()
+
+        @pytest.fixture(scope='module')
+        def mismatch(narrow):
+            return narrow
+
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('one'), lazy_fixture('two'))])
+        def test_func(arg1, arg2):
+            assert arg1 is arg2 is threading.main_thread()
+
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('mismatch'), lazy_fixture('two'))])
+        def test_scope_mismatch(arg1, arg2):
+            pass
+    """)
+    result = testdir.runpytest()
+    result.stdout.fnmatch_lines(['*ScopeMismatch*', '*1 passed*1 error*'])
+
+
+def test_lazy_fixtures_in_threads_skip(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def one():
+            pytest.skip('no one')
+
+        @pytest.fixture
+        def two():
+            return 2
+
+        @pytest.mark.lazy_fixture_threads
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('one'), lazy_fixture('two'))])
+        def test_func(arg1, arg2):
+            pass
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(skipped=1)
+
+
+def test_lazy_fixture_projections(testdir):
+    testdir.makepyfile("""
+        import collections
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        Dataset = collections.namedtuple('Dataset', 'rows size')
+
+        @pytest.fixture
+        def datasets():
+            return {'train': Dataset([1, 2, 3], 3), 'test': Dataset([4], 1)}
+
+        @pytest.fixture(params=[lazy_fixture('datasets')['test'].attr('size')])
+        def size(request):
+            return request.param
+
+        @pytest.mark.parametrize('rows,expected', [
+            (lazy_fixture('datasets')['train'].attr('rows'), [1, 2, 3]),
+            (lazy_fixture('datasets')['test'].attr('rows')[0], 4),
+            (lazy_fixture('datasets')['train'].attr('rows')[1:], [2, 3]),
+        ])
+        def test_func(rows, expected, size):
+            assert rows == expected
+            assert size == 1
+    """)
+    result = testdir.runpytest('-v')
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines([
+        '*test_func?datasets?test?.size-datasets?train?.rows-expected0? PASSED*',
+        '*test_func?datasets?test?.size-datasets?test?.rows?0?-4? PASSED*',
+        '*test_func?datasets?test?.size-datasets?train?.rows?1:?-expected2? PASSED*',
+    ])
+
+
+def test_lazy_fixture_projection_equality():
+    assert lazy_fixture('one').attr('value') is lazy_fixture('one').attr('value')
+    assert lazy_fixture('one')['a'] == lazy_fixture('one')['a']
+    assert lazy_fixture('one')['a'] != lazy_fixture('one')['b']
+    assert lazy_fixture('one').attr('a') != lazy_fixture('one')['a']
+    assert lazy_fixture('one').attr('a') != lazy_fixture('one')
+    assert lazy_fixture('one')[1:] == lazy_fixture('one')[1:]
+    assert repr(lazy_fixture('one')['a'].attr('b')) == '''<LazyFixture "one['a'].b">'''
+    assert not hasattr(lazy_fixture('one'), 'value')
+
+
+def test_lazy_fixture_is_not_iterable():
+    with pytest.raises(TypeError):
+        iter(lazy_fixture('one'))
+    with pytest.raises(TypeError):
+        list(lazy_fixture('one'))
+    with pytest.raises(TypeError):
+        'a' in lazy_fixture('one')
+
+
+def test_lazy_fixture_is_immutable():
+    one = lazy_fixture('one')
+    with pytest.raises(AttributeError):
+        one.name = 'two'
+    with pytest.raises(AttributeError):
+        one.other = 'two'
+    with pytest.raises(AttributeError):
+        del one.scope
+    assert lazy_fixture('one').name == 'one'
+
+
+def test_lazy_fixture_projection_of_reserved_names(testdir):
+    testdir.makepyfile("""
+        import collections
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        User = collections.namedtuple('User', 'name scope attr')
+
+        @pytest.fixture
+        def user():
+            return User('alice', 'admin', 'x')
+
+        @pytest.mark.parametrize('value,expected', [
+            (lazy_fixture('user').attr('name'), 'alice'),
+            (lazy_fixture('user').attr('scope'), 'admin'),
+            (lazy_fixture('user').attr('attr'), 'x'),
+        ])
+        def test_func(value, expected):
+            assert value == expected
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=3)
+
+
+def test_lazy_fixture_callable(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        built = []
+
+        @pytest.fixture(params=[1, 2], ids=['first', 'second'])
+        def one(request):
+            return request.param
+
+        @pytest.fixture
+        def model():
+            built.append('model')
+            return lambda x: x * 10
+
+        def predict(model, one):
+            return model(one)
+
+        @pytest.fixture(params=[lazy_fixture(lambda one: one + 100)])
+        def shifted(request):
+            return request.param
+
+        @pytest.mark.parametrize('arg', [lazy_fixture(predict)])
+        def test_func(arg, one, shifted):
+            assert arg == one * 10
+            assert shifted == one + 100
+
+        def test_other():
+            pass
+
+        def test_built():
+            assert built == ['model']
+    """)
+    result = testdir.runpytest('-v', '-k', 'not second')
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines([
+        '*test_func?first-shifted0-predict? PASSED*',
+    ])
+
+
+def test_lazy_fixture_callable_equality():
+    def func(one, two):
+        pass
+
+    assert lazy_fixture(func) is lazy_fixture(func)
+    assert lazy_fixture(func) != lazy_fixture('func')
+    assert lazy_fixture(func)._argnames == ('one', 'two')
+    assert repr(lazy_fixture(func)[0]) == '<LazyFixture "func(one, two)[0]">'
+
+
+def test_lazy_fixture_scoped_value(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        computed = []
+
+        @pytest.fixture(scope='module', params=['a', 'b'])
+        def model(request):
+            return request.param
+
+        def predict(model):
+            computed.append(model)
+            return model * 2
+
+        @pytest.mark.parametrize('n', range(3))
+        @pytest.mark.parametrize('prediction', [lazy_fixture(predict, scope='module')])
+        def test_func(prediction, n, model):
+            assert prediction == model * 2
+
+        def test_computed():
+            assert computed == ['a', 'b']
+    """)
+    result = testdir.runpytest('-v')
+    result.assert_outcomes(passed=7)
+
+
+def test_lazy_fixture_scoped_value_teardown(testdir):
+    testdir.makepyfile(test_a="""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        computed = []
+
+        @pytest.fixture(scope='session')
+        def counter():
+            return computed
+
+        def count(counter):
+            counter.append(1)
+            return len(counter)
+
+        @pytest.mark.parametrize('arg', [lazy_fixture(count, scope='module')] * 2)
+        def test_func(arg):
+            assert arg == 1
+    """, test_b="""
+        from test_a import *
+
+        @pytest.mark.parametrize('arg', [lazy_fixture(count, scope='module')] * 2)
+        def test_func(arg):
+            assert arg == 2
+    """)
+    result = testdir.runpytest('-v')
+    result.assert_outcomes(passed=4)
+
+
+def test_lazy_fixture_scoped_value_of_overridden_fixture(testdir):
+    testdir.makeconftest("""
+        import pytest
+
+        @pytest.fixture(scope='session')
+        def cfg():
+            return 'global'
+    """)
+    testdir.makepyfile(test_a="""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('cfg', scope='session')])
+        def test_func(arg):
+            assert arg == 'global'
+    """, test_b="""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(scope='session')
+        def cfg():
+            return 'override'
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('cfg', scope='session')])
+        def test_func(arg):
+            assert arg == 'override'
+    """)
+    result = testdir.runpytest('-v')
+    result.assert_outcomes(passed=2)
+
+
+def test_lazy_fixture_scoped_value_narrower_fixture(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def one():
+            return 1
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('one', scope='module')])
+        def test_func(arg):
+            pass
+    """)
+    result = testdir.runpytest()
+    result.stdout.fnmatch_lines([
+        '*<LazyFixture "one"> has scope ?module? but uses narrower-scoped fixtures: one (function)*',
+    ])
+    assert result.ret != 0
+
+
+def test_lazy_fixture_invalid_scope():
+    with pytest.raises(ValueError):
+        lazy_fixture('one', scope='modul')
+
+
+def test_lazy_fixture_graph(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(scope='session')
+        def db():
+            return 'db'
+
+        @pytest.fixture
+        def user(db):
+            return 'user'
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('user'), lazy_fixture('db')])
+        def test_func(arg):
+            pass
+
+        @pytest.mark.parametrize('arg', [1])
+        def test_plain(arg):
+            pass
+    """)
+    graph = testdir.tmpdir.join('graph.json')
+    result = testdir.runpytest('--lazy-fixture-graph={}'.format(graph))
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines(['lazy fixture graph written to *graph.json'])
+
+    data = json.loads(graph.read())
+    assert [item['nodeid'] for item in data['items']] == [
+        'test_lazy_fixture_graph.py::test_func[user]',
+        'test_lazy_fixture_graph.py::test_func[db]',
+    ]
+    assert data['items'][0]['lazy'] == [{
+        'argname': 'arg',
+        'value': '<LazyFixture "user">',
+        'uses': ['user'],
+        'fixtures': ['test_lazy_fixture_graph.py::db', 'test_lazy_fixture_graph.py::user'],
+    }]
+    assert [
+        (fixture['name'], fixture['scope'], fixture['setups'], fixture['repeated'], fixture['dependencies'])
+        for fixture in data['fixtures']
+    ] == [
+        ('db', 'session', 1, False, []),
+        ('user', 'function', 1, False, ['db']),
+    ]
+
+
+def test_lazy_fixture_graph_dot(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def user():
+            return 'user'
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('user')] * 2)
+        def test_func(arg):
+            pass
+    """)
+    graph = testdir.tmpdir.join('graph.dot')
+    result = testdir.runpytest('--lazy-fixture-graph={}'.format(graph))
+    result.assert_outcomes(passed=2)
+
+    dot = graph.read()
+    assert dot.startswith('digraph lazy_fixtures {')
+    assert (r'"test_lazy_fixture_graph_dot.py::user" '
+            r'[shape=ellipse, label="user\nfunction, 2 setups", color=red, fontcolor=red];') in dot
+    assert r'"test_lazy_fixture_graph_dot.py::test_func[user0]" -> "<LazyFixture \"user\">" [label="arg"];' in dot
+    assert r'"<LazyFixture \"user\">" -> "test_lazy_fixture_graph_dot.py::user";' in dot
+
+
+def test_lazy_fixtures_in_containers(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_containers = true
+    """)
+    testdir.makepyfile("""
+        import collections
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        Pair = collections.namedtuple('Pair', 'left right')
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+
+        @pytest.fixture
+        def two():
+            return 2
+
+        @pytest.fixture(params=[(lazy_fixture('two'), 'b')])
+        def some(request):
+            return request.param
+
+        shared = {'values': [lazy_fixture('one'), 0], 'pair': Pair(lazy_fixture('two'), 'x')}
+
+        @pytest.mark.parametrize('arg1,arg2', [
+            (shared, ('a', [lazy_fixture('arg1')['pair'].attr('left')])),
+            (shared, ('b', [3])),
+        ])
+        def test_func(arg1, arg2, one, some):
+            assert arg1 == {'values': [one, 0], 'pair': Pair(2, 'x')}
+            assert arg2[1][0] in (2, 3)
+            assert some == (2, 'b')
+            assert isinstance(arg1['pair'], Pair)
+            assert shared['values'][0] is lazy_fixture('one')
+    """)
+    result = testdir.runpytest('-v')
+    result.assert_outcomes(passed=4)
+
+
+def test_lazy_fixtures_in_containers_are_opt_in(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def user():
+            return 'alice'
+
+        @pytest.mark.parametrize('data', [{'u': lazy_fixture('user')}])
+        def test_func(data):
+            assert data == {'u': lazy_fixture('user')}
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=1)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='dataclasses require python 3.7')
+def test_lazy_fixtures_in_dataclass(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_containers = true
+    """)
+    testdir.makepyfile("""
+        import dataclasses
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @dataclasses.dataclass(frozen=True)
+        class Config:
+            name: str
+            value: object
+
+        @pytest.fixture
+        def one():
+            return 1
+
+        @pytest.mark.parametrize('config', [Config('a', lazy_fixture('one'))])
+        def test_func(config):
+            assert config == Config('a', 1)
+    """)
+    result = testdir.runpytest('-v')
+    result.assert_outcomes(passed=1)
+
+
+def test_lazy_leaves():
+    class Custom(list):
+        pass
+
+    one = lazy_fixture('one')
+    assert lazy_leaves((1, 'a', [2])) is None
+    assert lazy_leaves((1, {'a': [one], 'b': 2}, one)) == {1: {'a': {0: None}}, 2: None}
+    assert lazy_leaves([Custom([one])]) is None
+
+    recursive = [one]
+    recursive.append(recursive)
+    assert lazy_leaves(recursive) == {0: None}
+
+    inner = {'u': one}
+    assert lazy_leaves([inner, (inner,)]) == {0: {'u': None}, 1: {0: {'u': None}}}
+
+
+def test_lazy_fixtures_in_shared_containers(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_containers = true
+    """)
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def user():
+            return 'alice'
+
+        inner = {'u': lazy_fixture('user')}
+
+        @pytest.mark.parametrize('data', [[inner, inner]])
+        def test_func(data):
+            assert data == [{'u': 'alice'}, {'u': 'alice'}]
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=1)
+
+
+@pytest.mark.skipif(ThreadPoolExecutor is None, reason='concurrent.futures is not available')
+def test_collect_modules_concurrently(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_containers = true
+    """)
+    testdir.makeconftest("""
+        import pytest
+
+        @pytest.fixture(params=[1, 2])
+        def one(request):
+            return request.param
+    """)
+    paths = [
+        testdir.makepyfile(**{'test_module{}'.format(i): """
+            import pytest
+            from pytest_lazyfixture import lazy_fixture
+
+            @pytest.fixture(params=[{i}, {j}])
+            def two(request):
+                return request.param
+
+            @pytest.mark.parametrize('arg1,arg2', [
+                (lazy_fixture('one'), lazy_fixture('two')),
+                ('val', (lazy_fixture('two'), 0)),
+            ])
+            def test_func(arg1, arg2):
+                pass
+
+            class TestClass(object):
+                @pytest.mark.parametrize('arg', [lazy_fixture('two')])
+                def test_method(self, arg):
+                    pass
+        """.format(i=i, j=i + 100)})
+        for i in range(16)
+    ]
+    session = testdir.getnode(testdir.parseconfigure(), paths[0]).session
+    modules = session.perform_collect([str(path) for path in paths], genitems=False)
+    assert len(modules) == len(paths)
+
+    def collect(module):
+        return [
+            (item.name, item.callspec.params.get('one'), item.callspec.params.get('two'))
+            for item in testdir.genitems([module])
+        ]
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(collect, modules))
+
+    for i, items in enumerate(results):
+        j = i + 100
+        assert items == [
+            ('test_func[one-two-1-{}]'.format(i), 1, i),
+            ('test_func[one-two-1-{}]'.format(j), 1, j),
+            ('test_func[one-two-2-{}]'.format(i), 2, i),
+            ('test_func[one-two-2-{}]'.format(j), 2, j),
+            ('test_func[val-arg21-{}]'.format(i), None, i),
+            ('test_func[val-arg21-{}]'.format(j), None, j),
+            ('test_method[two-{}]'.format(i), None, i),
+            ('test_method[two-{}]'.format(j), None, j),
+        ]
+
+
+def test_thread_local_var():
+    var = _ThreadLocalVar('var')
+    token = var.set('main')
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(var.get()))
+    thread.start()
+    thread.join()
+    assert seen == [None]
+    assert var.get() == 'main'
+    var.reset(token)
+    assert var.get() is None
+
+
+def test_getfixturevalues_once_per_item(testdir):
+    testdir.makepyfile("""
+        import itertools
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        counter = itertools.count()
+
+        @pytest.fixture
+        def data():
+            return {'a': 1, 'id': next(counter)}
+
+        @pytest.mark.parametrize('arg1,arg2,arg3', [
+            (lazy_fixture('data'), lazy_fixture('data')['a'], lazy_fixture(lambda data: data['id'])),
+        ] * 2)
+        def test_func(arg1, arg2, arg3):
+            assert arg2 == 1
+            assert arg3 == arg1['id']
+    """)
+    profile = testdir.tmpdir.join('profile.json')
+    result = testdir.runpytest('-v', '--lazy-fixture-profile-json', str(profile))
+    result.assert_outcomes(passed=2)
+
+    fixtures = {stat['name']: stat for stat in json.loads(profile.read())['fixtures']}
+    assert fixtures['data']['count'] == 2
+
+
+def test_getfixturevalues(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import getfixturevalues
+
+        @pytest.fixture
+        def one():
+            return 1
+
+        @pytest.fixture
+        def two(one):
+            return one + 1
+
+        def test_func(request):
+            assert getfixturevalues(request, ['two', 'one', 'two']) == [2, 1, 2]
+            assert request.node._lazyfixture_values == {'one': 1, 'two': 2}
+    """)
+    reprec = testdir.inline_run()
+    reprec.assertoutcome(passed=1)
+
+
+def test_lazy_fixture_compact_ids(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_id_max_length = 30
+    """)
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[1, 2])
+        def a_fixture_with_a_long_name(request):
+            return request.param
+
+        @pytest.fixture
+        def short():
+            return 0
+
+        @pytest.mark.parametrize('arg1,arg2', [
+            (lazy_fixture('a_fixture_with_a_long_name'), lazy_fixture('a_fixture_with_a_long_name')),
+            (lazy_fixture('short'), 1),
+        ])
+        def test_func(arg1, arg2):
+            pass
+
+        @pytest.mark.parametrize('arg', ['a plain value that is longer than thirty characters'])
+        def test_plain(arg):
+            pass
+    """)
+    items, _ = testdir.inline_genitems()
+    ids = [item.callspec.id for item in items]
+    assert [len(callspec_id) for callspec_id in ids[:2]] == [30, 30]
+    assert ids[0].startswith('a_fixture_with_a_lo-')
+    assert ids[0] != ids[1]
+    assert ids[2:] == ['short-1', 'a plain value that is longer than thirty characters']
+
+
+@pytest.mark.parametrize('max_length,expected_lengths', [(10, [10, 10]), (11, [10, 10]), (12, [12, 12])])
+def test_lazy_fixture_compact_ids_small_limit(testdir, max_length, expected_lengths):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_id_max_length = %d
+    """ % max_length)
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[1, 2])
+        def a_fixture_with_a_long_name(request):
+            return request.param
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('a_fixture_with_a_long_name')])
+        def test_func(arg):
+            pass
+    """)
+    items, _ = testdir.inline_genitems()
+    ids = [item.callspec.id for item in items]
+    assert [len(callspec_id) for callspec_id in ids] == expected_lengths
+    assert ids[0] != ids[1]
+
+
+@pytest.mark.parametrize('max_length', ['5', '-1', 'short'])
+def test_lazy_fixture_id_max_length_is_validated(testdir, max_length):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_id_max_length = %s
+    """ % max_length)
+    testdir.makepyfile("""
+        def test_func():
+            pass
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 4
+    result.stderr.fnmatch_lines([
+        "*lazy_fixture_id_max_length must be 0 or at least 10, got '%s'*" % max_length
+    ])
+
+
+def test_lazy_fixture_id_is_memoized():
+    val = lazy_fixture('one')['a']
+    assert pytest_make_parametrize_id(None, val, 'arg') == "one[a]"
+    assert val._id == 'one[a]'
+    assert pytest_make_parametrize_id(None, lazy_fixture('one')['a'], 'arg') is val._id
+
+
+def test_unknown_lazy_fixtures_fail_collection(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(scope='session')
+        def db():
+            raise AssertionError('must not be set up')
+
+        @pytest.fixture
+        def user():
+            return 'user'
+
+        @pytest.mark.parametrize('arg1,arg2', [
+            (lazy_fixture('dbb'), lazy_fixture('user')),
+            (lazy_fixture('usr'), lazy_fixture('dbb')),
+            (lazy_fixture('arg2'), lazy_fixture(lambda request, db: db)),
+        ])
+        def test_func(arg1, arg2, db):
+            pass
+
+        def test_other(db):
+            pass
+    """)
+    result = testdir.runpytest()
+    result.stdout.fnmatch_lines([
+        '*test_func: lazy_fixture refers to unknown fixtures:',
+        "*  'dbb' used by arg1, arg2",
+        "*  'usr' used by arg1",
+        '*1 error*',
+    ])
+    assert 'must not be set up' not in result.stdout.str()
+    assert result.ret != 0
+
+
+def test_sorted_by_dependency_cycle():
+    with pytest.raises(pytest.fail.Exception) as excinfo:
+        sorted_by_dependency({'a': lf('b'), 'b': lf('c'), 'c': lf('b'), 'd': lf('a'), 'e': 1}, [])
+    assert str(excinfo.value) == 'lazy fixtures depend on each other in a cycle: b -> c -> b'
+
+
+def test_lazy_fixture_cycle_fails_collection(testdir):
+    testdir.makepyfile(test_params="""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.mark.parametrize('arg1,arg2', [(lazy_fixture('arg2'), lazy_fixture('arg1'))])
+        def test_func(arg1, arg2):
+            pass
+    """, test_fixtures="""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture(params=[lazy_fixture('two')])
+        def one(request):
+            return request.param
+
+        @pytest.fixture(params=[lazy_fixture('one')])
+        def two(request):
+            return request.param
+
+        def test_func(one):
+            pass
+    """)
+    result = testdir.runpytest()
+    result.stdout.fnmatch_lines([
+        '*ERROR collecting test_fixtures.py*',
+        '*lazy fixtures depend on each other in a cycle: one -> two -> one',
+        '*ERROR collecting test_params.py*',
+        '*lazy fixtures depend on each other in a cycle: arg1 -> arg2 -> arg1',
+        '*2 error*',
+    ])
+    assert 'During handling' not in result.stdout.str()
+    assert result.ret != 0
+
+
+def test_lazy_fixture_max_depth(testdir):
+    testdir.makeini("""
+        [pytest]
+        lazy_fixture_max_depth = 2
+    """)
+    testdir.makepyfile("""
+        import pytest
+        from pytest_lazyfixture import lazy_fixture
+
+        @pytest.fixture
+        def level0():
+            return 0
+
+        @pytest.fixture(params=[lazy_fixture('level0')])
+        def level1(request):
+            return request.param
+
+        @pytest.fixture(params=[lazy_fixture('level1')])
+        def level2(request):
+            return request.param
+
+        @pytest.fixture(params=[lazy_fixture('level2')])
+        def level3(request):
+            return request.param
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('level2')])
+        def test_shallow(arg):
+            assert arg == 0
+
+        @pytest.mark.parametrize('arg', [lazy_fixture('level3')])
+        def test_deep(arg):
+            pass
+    """)
+    result = testdir.runpytest()
+    result.stdout.fnmatch_lines([
+        '*lazy fixtures are nested deeper than lazy_fixture_max_depth=2: level3 -> level2 -> level1*',
+    ])
+
+    result = testdir.runpytest('-k', 'test_shallow', '-o', 'lazy_fixture_max_depth=0')
+    result.assert_outcomes(passed=1)